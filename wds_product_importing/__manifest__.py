@@ -14,7 +14,7 @@
     'website': 'https://www.odoo.com/',
 
     'category': 'Custom Development',
-    'version': '1.0',
+    'version': '1.2',
     'license': 'OEEL-1',
 
     # any module necessary for this one to work correctly
@@ -29,9 +29,11 @@
 
     # always loaded
     'data': [
+        'security/ir.model.access.csv',
         'data/actions.xml',
         'data/data.xml',
         'views/documents_views.xml',
+        'views/product_import_batch_views.xml',
         'views/product_template_views.xml',
         'views/product_product_views.xml',
         'views/templates.xml',
@@ -15,18 +15,12 @@ class WebsiteSale(WebsiteSale):
     def _get_search_domain(self, search, category, attrib_values, search_in_description=True):
         domains = [request.website.sale_product_domain()]
         if search:
-            subdomains = [
-                [('name', 'ilike', search)],
-                # [('product_variant_ids.default_code', 'ilike', search)],
-                # [('product_variant_ids.product_code', 'ilike', search)],
-                # [('product_variant_ids.mfr_num', 'ilike', search)],
-                # [('product_variant_ids.mfr_name', 'ilike', search)],
-                # [('product_variant_ids.vendor_name', 'ilike', search)],
-            ]
+            # Names in every installed language, catalog and manufacturer numbers (and descriptions) are
+            # gathered in trigram indexed columns, so the search never scans the whole product table
             if search_in_description:
-                subdomains.append([('description', 'ilike', search)])
-                subdomains.append([('description_sale', 'ilike', search)])
-            domains.append(expression.OR(subdomains))
+                domains.append([('website_search_text', 'ilike', search)])
+            else:
+                domains.append([('website_search_name', 'ilike', search)])
 
         if category:
             domains.append([('public_categ_ids', 'child_of', int(category))])
@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+
+def migrate(cr, version):
+    # Fill product_product.base_cost from the standard_price properties of the main company
+    cr.execute('''
+        UPDATE product_product
+        SET base_cost = ir_property.value_float
+        FROM ir_property
+        JOIN ir_model_fields ON ir_model_fields.id = ir_property.fields_id
+        WHERE
+            ir_model_fields.model = 'product.product'
+            AND ir_model_fields.name = 'standard_price'
+            AND ir_property.res_id = 'product.product,' || product_product.id
+            AND ir_property.company_id = (SELECT id FROM res_company ORDER BY id LIMIT 1)
+    ''')
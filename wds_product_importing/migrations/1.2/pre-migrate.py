@@ -0,0 +1,14 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+from odoo.addons.wds_product_importing.models.sql_queries import _queries
+from odoo.tools import split_every
+
+
+def migrate(cr, version):
+    # Create and fill the search columns in SQL, so that the ORM doesn't recompute them for every product
+    cr.execute('ALTER TABLE product_template ADD COLUMN IF NOT EXISTS website_search_text TEXT')
+    cr.execute('ALTER TABLE product_template ADD COLUMN IF NOT EXISTS website_search_name TEXT')
+    cr.execute('SELECT id FROM product_template')
+    for ids in split_every(10000, [row[0] for row in cr.fetchall()]):
+        cr.execute(_queries['write_website_search_text'], {'tmpl_ids': tuple(ids)})
@@ -8,4 +8,7 @@ from . import product_template
 from . import product
 from . import res_company
 from . import res_config_settings
-from . import ir_http
\ No newline at end of file
+from . import ir_http
+from . import product_image_job
+from . import product_image_source
+from . import product_import_batch
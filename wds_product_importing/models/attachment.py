@@ -2,131 +2,305 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
 import base64
+import hashlib
 import itertools
 import logging
 import csv
 import io
 import mimetypes
-from odoo import api, fields, models, _
+import os
+import tempfile
+from odoo import fields, models
 
-try:
-    import xlrd
-    try:
-        from xlrd import xlsx
-    except ImportError:
-        xlsx = None
-except ImportError:
-    xlrd = xlsx = None
+from .xlsx_reader import iter_xlsx_rows
 
 _logger = logging.getLogger(__name__)
 
 class XlsxIterator:
-    def __init__(self, sheet):
-        self.sheet = sheet
-        self.nrows = sheet.nrows
-        self.current_row = 1
+    ''' Iterates over the rows of the first sheet of an xlsx file, streaming the sheet xml.
+
+    `current_row` is the index of the next row. When starting after the header row, the header
+    is read into `headers` and is not returned by the iterator.
+    '''
+    def __init__(self, fileobj, current_row=1):
+        self.rows = iter_xlsx_rows(fileobj, skip_before=current_row)
+        self.headers = next(self.rows, (0, []))[1] if current_row > 0 else []
+        self.current_row = current_row
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        if self.current_row >= self.nrows:
-            raise StopIteration
-        row = self.sheet.row_values(self.current_row)
-        self.current_row += 1
+        index, row = next(self.rows)
+        self.current_row = index + 1
         return row
 
-class XlsxDictIterator(XlsxIterator):
-    def __init__(self, sheet):
-        super().__init__(sheet)
-        self.headers = sheet.row_values(0)
+    def close(self):
+        self.rows.close()
+
+def csv_record(values):
+    output = io.StringIO()
+    csv.writer(output).writerow(values)
+    return output.getvalue().encode('utf-8')
+
+class FilestoreWriter:
+    ''' Writes a file straight into the filestore while computing its checksum, so that an attachment
+    can point to it without the whole content ever being held in memory or base64 encoded. '''
+    def __init__(self, Attachment):
+        self.Attachment = Attachment
+        directory = os.path.join(Attachment._filestore(), 'wds_split')
+        os.makedirs(directory, exist_ok=True)
+        fd, self.tmp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+        self.file = os.fdopen(fd, 'wb')
+        self.sha = hashlib.sha1()
+        self.size = 0
+        self.rows = 0
+
+    def write(self, data):
+        self.file.write(data)
+        self.sha.update(data)
+        self.size += len(data)
+
+    def discard(self):
+        self.file.close()
+        try:
+            os.unlink(self.tmp_path)
+        except FileNotFoundError:
+            pass  # Already moved to the filestore by save()
+
+    def save(self, name, mimetype='text/csv'):
+        ''' Move the file to its place in the filestore and return a new ir.attachment pointing to it. '''
+        self.file.close()
+        Attachment = self.Attachment.with_context(no_document=True)
+        if Attachment._storage() != 'file':
+            with open(self.tmp_path, 'rb') as f:
+                attachment = Attachment.create({'name': name, 'mimetype': mimetype, 'raw': f.read()})
+            os.unlink(self.tmp_path)
+            return attachment
+        checksum = self.sha.hexdigest()
+        fname = checksum[:2] + '/' + checksum
+        full_path = Attachment._full_path(fname)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        if os.path.isfile(full_path):
+            os.unlink(self.tmp_path)  # Same checksum, same content
+        else:
+            os.replace(self.tmp_path, full_path)
+        Attachment._mark_for_gc(fname)
+        attachment = Attachment.create({'name': name, 'mimetype': mimetype, 'type': 'binary'})
+        Attachment._cr.execute(
+            'UPDATE ir_attachment SET store_fname = %s, file_size = %s, checksum = %s WHERE id = %s',
+            (fname, self.size, checksum, attachment.id)
+        )
+        attachment.invalidate_cache(['store_fname', 'file_size', 'checksum'], attachment.ids)
+        return attachment
+
+class CsvReader:
+    ''' Reads csv rows as lists as long as the header row, keeping track of the byte offset where the
+    next row starts.
+
+    Lines are pulled from the file one at a time, so once a row is returned the file position is
+    exactly at the start of the next record, even when quoted values span multiple lines.
+    '''
+    def __init__(self, fileobj, offset=0):
+        self.fileobj = fileobj
+        self.fileobj.seek(0)
+        self.raw_lines = []
+        self.rows = csv.reader(self._lines())
+        self.headers = next(self.rows, [])
+        if offset:
+            self.fileobj.seek(offset)
+
+    def _lines(self):
+        for line in iter(self.fileobj.readline, b''):
+            self.raw_lines.append(line)
+            yield line.decode('utf-8-sig')
+
+    def __iter__(self):
+        return self
+
+    def _next_row(self):
+        self.raw_lines = []
+        row = next(self.rows)
+        while not row:  # Skip blank lines like csv.DictReader does
+            row = next(self.rows)
+        return row
 
     def __next__(self):
-        row = super().__next__()
-        return dict(zip(self.headers, row))
+        row = self._next_row()
+        width = len(self.headers)
+        # Missing cells are None and extra ones are dropped, like csv.DictReader would
+        return row[:width] if len(row) >= width else row + [None] * (width - len(row))
+
+    def next_csv_record(self):
+        ''' Return the next row as the raw bytes of its csv record, or None at the end of the file. '''
+        try:
+            self._next_row()
+        except StopIteration:
+            return None
+        record = b''.join(self.raw_lines)
+        return record if record.endswith(b'\n') else record + b'\r\n'
+
+    def read(self, size):
+        return list(itertools.islice(self, size))
+
+    def tell(self):
+        return self.fileobj.tell()
+
+    def close(self):
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class XlsxReader(XlsxIterator):
+    ''' Reads xlsx rows as lists. The position of the next batch is the index of its first row. '''
+    def __init__(self, fileobj, offset=0):
+        self.fileobj = fileobj
+        super().__init__(fileobj, max(offset, 1))
+
+    def read(self, size):
+        return list(itertools.islice(self, size))
+
+    def next_csv_record(self):
+        ''' Return the next row encoded as a utf-8 csv record, or None at the end of the sheet. '''
+        row = next(self.rows, None)
+        if row is None:
+            return None
+        self.current_row = row[0] + 1
+        return csv_record(row[1])
+
+    def tell(self):
+        return self.current_row
+
+    def close(self):
+        super().close()
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class BigInteger(fields.Integer):
+    ''' Integer stored as int8, for csv byte offsets that don't fit the int4 column of fields.Integer
+    once a file is larger than 2 GiB. '''
+    column_type = ('int8', 'int8')
+    column_cast_from = ('int4', 'float8')
 
 class IrAttachment(models.Model):
     _inherit = 'ir.attachment'
 
     batch = fields.Integer(default=0)
+    batch_offset = BigInteger(default=0, help="Where the next batch to import starts: a byte offset for csv files, a row index for xlsx files.")
+    batch_row = fields.Integer(default=0, help="Number of data rows already imported.")
+    import_batch_size = fields.Integer(default=0, help="Batch size tuned by the last import of this file, 0 until it is first imported.")
+    split_offset = BigInteger(default=0, help="Where the next part of an interrupted split starts.")
+    split_part = fields.Integer(default=0, help="Number of parts already written by an interrupted split.")
+    split_source_id = fields.Many2one('ir.attachment', help="File this part was split from, until its document is created.")
 
-    def _read_as_dict_list(self, start=0, end=None):
+    def _open_raw(self):
+        ''' Open the attachment content as a binary file, reading straight from the filestore when possible. '''
+        self.ensure_one()
+        if self.store_fname:
+            return open(self._full_path(self.store_fname), 'rb')
+        return io.BytesIO(base64.b64decode(self.datas or b''))
+
+    def _get_spreadsheet_reader(self, offset=0):
+        ''' Parse the file once and return a reader positioned at `offset` that yields batches of dict rows. '''
         self.ensure_one()
         filetype = mimetypes.guess_extension(self.mimetype)
-        data = base64.b64decode(self.datas)
+        if filetype not in ('.xlsx', '.csv'):
+            _logger.error(f'Cannot import from {self.name} since it is not the right filetype.')
+            return None
         try:
             if filetype == '.xlsx':
-                sheet = xlrd.open_workbook(file_contents=data).sheet_by_index(0)
-                return itertools.islice(XlsxDictIterator(sheet), start, end)
-            elif filetype == '.csv':
-                return itertools.islice(csv.DictReader(io.StringIO(data.decode('utf-8-sig'))), start, end)
-            else:
-                _logger.error(f'Cannot import from {self.name} since it is not the right filetype.')
-                return []
-        except:
+                return XlsxReader(self._open_raw(), offset)
+            return CsvReader(self._open_raw(), offset)
+        except Exception:
             _logger.error(f'Failed reading file data for {self.name}')
-  
+            return None
+
 
 class Document(models.Model):
     _inherit = 'documents.document'
 
-    def _get_spreadsheet_iterator(self):
-        self.ensure_one()
-        filetype = mimetypes.guess_extension(self.mimetype)
-        data = base64.b64decode(self.datas)
-        if filetype == '.csv':
-            return csv.reader(io.StringIO(data.decode('utf-8')))
-        elif filetype == '.xlsx':
-            sheet = xlrd.open_workbook(file_contents=data).sheet_by_index(0)
-            return XlsxIterator(sheet)
-        else:
-            raise NotImplemented(_("Cannot handle files that are not csv or xlsx!"))
-
-    def _split_document(self, rows = 100000):
+    def _split_document(self, rows=None, max_bytes=None):
         self = self.with_context(prefetch_fields=False)
         for document in self:
             try:
                 document._prefetch_ids = document._ids
-                document._split_rows(rows=rows)
+                document._split_rows(rows=rows, max_bytes=max_bytes)
                 document.invalidate_cache()
             except Exception as e:
-                # We usually get a memory error here from trying to cache all file data at once.
                 _logger.error(f'Failed reading file data for {document.name}\nError: {e}')
+                self._cr.rollback()
+
+    def _split_rows(self, rows=None, max_bytes=None):
+        ''' Split the document into csv parts of at most `rows` rows and `max_bytes` bytes.
 
-    def _split_rows(self, rows = 100000):
+        Parts are streamed straight to the filestore: csv records are copied as is and xlsx rows are
+        encoded one at a time. Progress is committed after every part so that an interrupted split
+        resumes after the last written part. Documents for all parts are created together at the end.
+        '''
         self.ensure_one()
         company = self.company_id or self.env.company
-        row_iterator = self._get_spreadsheet_iterator()
-        headers = next(row_iterator)
-        batch = 1
-        current_row = 0
-        for row in row_iterator:
-            if current_row >= rows:
-                part_data = base64.b64encode(output.getvalue().encode('utf-8'))
-                newfile = self.env['documents.document'].create({
-                    "name": f"{self.attachment_name.split('.')[0]}_Split_{batch}.csv",
-                    "datas": part_data,
-                    "folder_id": self.folder_id.id
-                })
-                _logger.info(f"Split file created: {newfile.name}")
-              
-                current_row = 0
-                batch += 1
-            if current_row == 0:
-                output = io.StringIO()
-                writer = csv.writer(output)
-                writer.writerow(headers)
-            writer.writerow(row)
-            current_row += 1
-        if (batch == 1 and mimetypes.guess_extension(self.mimetype) == '.csv' and "_Split_" in self.attachment_name) or current_row == 0: # File is smaller than batch size and in csv format and has already been split, no need to split into multiple files
-            return True
-        part_data = base64.b64encode(output.getvalue().encode('utf-8'))
-        newfile = self.env['documents.document'].create({
-            "name": f"{self.attachment_name.split('.')[0]}_Split_{batch}.csv",
-            "datas": part_data,
-            "folder_id": self.folder_id.id
-        })
-        _logger.info(f"Split file created: {newfile.name}")
+        rows = rows or company.split_part_rows
+        max_bytes = max_bytes or company.split_part_size * 1024 * 1024
+        source = self.attachment_id
+        reader = source._get_spreadsheet_reader(source.split_offset)
+        if reader is None:
+            return False
+        part = None
+        try:
+            with reader:
+                header = csv_record(reader.headers)
+                while True:
+                    position = reader.tell()
+                    record = reader.next_csv_record()
+                    if record is None:
+                        break
+                    if part and (part.rows >= rows or (max_bytes and part.size + len(record) > max_bytes)):
+                        self._save_split_part(part, position)
+                        part = None
+                    if part is None:
+                        part = FilestoreWriter(self.env['ir.attachment'])
+                        part.write(header)
+                    part.write(record)
+                    part.rows += 1
+                position = reader.tell()
+            if not source.split_part and (part is None or (mimetypes.guess_extension(self.mimetype) == '.csv' and "_Split_" in self.attachment_name)):
+                # Empty file, or file smaller than the part size and already split, no need to split into multiple files
+                if part:
+                    part.discard()
+                return True
+            if part:
+                self._save_split_part(part, position)
+        except Exception:
+            # Don't leave the temporary file of the part being written behind in the filestore
+            if part:
+                part.discard()
+            raise
+        parts = self.env['ir.attachment'].search([('split_source_id', '=', source.id)], order='id')
+        new_documents = self.env['documents.document'].create([{
+            'name': attachment.name,
+            'attachment_id': attachment.id,
+            'folder_id': self.folder_id.id,
+        } for attachment in parts])
+        parts.write({'split_source_id': False})
+        source.write({'split_offset': 0, 'split_part': 0})
+        _logger.info(f"{len(new_documents)} split files created for {self.attachment_name}")
 
         self.folder_id = company.complete_import_folder.id
         return True
+
+    def _save_split_part(self, part, position):
+        source = self.attachment_id
+        attachment = part.save(f"{self.attachment_name.split('.')[0]}_Split_{source.split_part + 1}.csv")
+        attachment.split_source_id = source
+        source.write({'split_part': source.split_part + 1, 'split_offset': position})
+        self._cr.commit()
+        _logger.info(f"Split part written: {attachment.name}")
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+
+_logger = logging.getLogger(__name__)
+
+_caches = {}
+
+
+def get_image_cache(path, max_bytes, max_age):
+    ''' Return the image cache stored in `path`, shared by every cursor of this worker. '''
+    cache = _caches.get(path)
+    if cache is None:
+        cache = _caches[path] = ImageCache(path, max_bytes, max_age)
+    cache.max_bytes = max_bytes
+    cache.max_age = max_age
+    return cache
+
+
+class ImageCache:
+    ''' Byte bounded LRU cache of downloaded images, stored on the filestore so it is shared by all
+    workers and survives restarts.
+
+    Every url has a small json entry holding its validators (ETag / Last-Modified) and the name of
+    the blob with the image bytes. Blobs are named after the url and its validators, and their mtime
+    is bumped on every hit so that the least recently used ones are evicted first.
+    '''
+
+    def __init__(self, path, max_bytes, max_age):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self._size = None
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def _key(*parts):
+        return hashlib.sha1('\n'.join(part or '' for part in parts).encode('utf-8')).hexdigest()
+
+    def _entry_path(self, url):
+        return os.path.join(self.path, self._key(url) + '.json')
+
+    def _write_atomic(self, path, data):
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def get(self, url):
+        ''' Return the entry cached for url or None.
+
+        The entry is a dict with the image `data`, its `etag` and `last_modified` validators and
+        `fresh`, telling whether it was validated recently enough to be used without asking the server.
+        '''
+        try:
+            with open(self._entry_path(url), 'rb') as f:
+                entry = json.loads(f.read())
+            blob_path = os.path.join(self.path, entry['blob'])
+            with open(blob_path, 'rb') as f:
+                entry['data'] = f.read()
+            os.utime(blob_path)
+        except (OSError, ValueError, KeyError):
+            return None
+        entry['fresh'] = time.time() - entry.get('validated', 0) < self.max_age
+        return entry
+
+    def put(self, url, data, etag=None, last_modified=None):
+        url_key = self._key(url)
+        blob = f'{url_key}.{self._key(etag, last_modified)}.img'
+        previous = None
+        try:
+            with open(self._entry_path(url), 'rb') as f:
+                previous = json.loads(f.read()).get('blob')
+        except (OSError, ValueError):
+            pass
+        try:
+            self._write_atomic(os.path.join(self.path, blob), data)
+            self._write_atomic(self._entry_path(url), json.dumps({
+                'url': url,
+                'etag': etag,
+                'last_modified': last_modified,
+                'blob': blob,
+                'validated': time.time(),
+            }).encode('utf-8'))
+            if previous and previous != blob:
+                os.unlink(os.path.join(self.path, previous))
+        except OSError as e:
+            _logger.warning(f'Could not store {url} in the image cache: {e}')
+            return
+        if self._size is not None:
+            self._size += len(data)
+        if self._size is None or self._size > self.max_bytes:
+            self._evict()
+
+    def revalidated(self, url):
+        ''' Mark the entry for url as fresh again, after the server answered 304 Not Modified. '''
+        try:
+            entry_path = self._entry_path(url)
+            with open(entry_path, 'rb') as f:
+                entry = json.loads(f.read())
+            entry['validated'] = time.time()
+            self._write_atomic(entry_path, json.dumps(entry).encode('utf-8'))
+        except (OSError, ValueError):
+            pass
+
+    def _evict(self):
+        ''' Remove the least recently used blobs until the cache fits in 90% of its budget. '''
+        blobs = []
+        for name in os.listdir(self.path):
+            if not name.endswith('.img'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, name))
+        self._size = sum(size for _mtime, size, _name in blobs)
+        if self._size <= self.max_bytes:
+            return
+        target = self.max_bytes * 0.9
+        evicted = 0
+        for _mtime, size, name in sorted(blobs):
+            if self._size <= target:
+                break
+            url_key = name.split('.', 1)[0]
+            for path in (os.path.join(self.path, name), os.path.join(self.path, url_key + '.json')):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+            self._size -= size
+            evicted += 1
+        _logger.info(f'Evicted {evicted} images from the image cache, {self._size} bytes left.')
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import base64
+import io
+import itertools
+import logging
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from PIL import Image
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_logger = logging.getLogger(__name__)
+
+# Returned instead of an image when the server confirmed that the image we already have is up to date
+NOT_MODIFIED = object()
+
+
+def download_image(session, url, headers=None, timeout=3, maxsize=10 * 1024 * 1024):
+    ''' Download an image with the same limits as base_import, returning its content and validators.
+
+    A 304 answer to a conditional request is returned as {'status': 304} without content.
+    '''
+    try:
+        response = session.get(url, headers=headers or {}, timeout=timeout)
+        if response.status_code == 304 and headers:
+            return {'status': 304}
+        response.raise_for_status()
+        if response.headers.get('Content-Length') and int(response.headers['Content-Length']) > maxsize:
+            raise ValueError(f"File size exceeds configured maximum ({maxsize} bytes)")
+        content = bytearray()
+        for chunk in response.iter_content(32768):
+            content += chunk
+            if len(content) > maxsize:
+                raise ValueError(f"File size exceeds configured maximum ({maxsize} bytes)")
+        image = Image.open(io.BytesIO(content))
+        w, h = image.size
+        if w * h > 42e6:
+            raise ValueError("Image size excessive, imported images must be smaller than 42 million pixel")
+    except Exception as e:
+        raise ValueError(f"Could not retrieve URL: {url}: {e}")
+    return {
+        'status': response.status_code,
+        'content': bytes(content),
+        'etag': response.headers.get('ETag'),
+        'last_modified': response.headers.get('Last-Modified'),
+        'content_length': len(content),
+    }
+
+
+def fetch_image_response(cache, session, url, timeout=3, maxsize=10 * 1024 * 1024, validators=None):
+    ''' Get the image at url, going through the image cache, and return a dict with the base64 encoded
+    image in `data` and, when the server was asked, the `etag`, `last_modified` and `content_length`
+    of its answer.
+
+    Entries validated recently are used as is, older ones are revalidated with a conditional request.
+    Without a cache entry, a conditional request is sent with `validators` (the etag and last_modified
+    of an image stored earlier) when given; if the server answers 304, `data` is NOT_MODIFIED.
+    This never touches the database so it can run outside of the cursor's thread.
+    '''
+    entry = cache.get(url)
+    if entry and entry['fresh']:
+        return {'data': base64.b64encode(entry['data'])}
+    headers = {}
+    known = entry or validators or {}
+    if known.get('etag'):
+        headers['If-None-Match'] = known['etag']
+    if known.get('last_modified'):
+        headers['If-Modified-Since'] = known['last_modified']
+    response = download_image(session, url, headers, timeout, maxsize)
+    if response['status'] == 304:
+        if entry:
+            cache.revalidated(url)
+            return {'data': base64.b64encode(entry['data'])}
+        return {'data': NOT_MODIFIED}
+    cache.put(url, response['content'], response['etag'], response['last_modified'])
+    return {
+        'data': base64.b64encode(response['content']),
+        'etag': response['etag'],
+        'last_modified': response['last_modified'],
+        'content_length': response['content_length'],
+    }
+
+
+def fetch_image(cache, session, url, timeout=3, maxsize=10 * 1024 * 1024):
+    ''' Return the base64 encoded image at url, going through the image cache. '''
+    return fetch_image_response(cache, session, url, timeout, maxsize)['data']
+
+
+class ImageFetcher:
+    ''' Downloads batches of images concurrently over pooled keep-alive connections.
+
+    At most `per_host` downloads run against the same host at once, transient errors are retried with
+    a backoff, and every batch logs its completed count and the throughput of each host.
+    '''
+
+    def __init__(self, cache, workers=16, per_host=4, timeout=3, maxsize=10 * 1024 * 1024, retries=3):
+        self.cache = cache
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.maxsize = maxsize
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=workers,
+            pool_maxsize=workers,
+            max_retries=Retry(total=retries, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504)),
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._host_locks = defaultdict(lambda: threading.BoundedSemaphore(self.per_host))
+        self._host_locks_lock = threading.Lock()
+        self.errors = {}
+        self.responses = {}
+
+    def _host_lock(self, host):
+        with self._host_locks_lock:
+            return self._host_locks[host]
+
+    def _fetch(self, url, validators=None):
+        host = urlsplit(url).netloc
+        with self._host_lock(host):
+            start = time.perf_counter()
+            try:
+                response, error = fetch_image_response(self.cache, self.session, url, self.timeout, self.maxsize, validators), None
+            except Exception as e:
+                response, error = None, e
+            return host, response, error, time.perf_counter() - start
+
+    def fetch(self, urls, validators=None):
+        ''' Download every url, returning a dict mapping each url to its base64 image, NOT_MODIFIED or None
+        on failure. `validators` maps urls to the etag and last_modified of the image stored for them,
+        to ask the server whether it changed. Until the next call, the error of each failed url is kept in
+        `errors` and the validators of each image the server sent in `responses`. '''
+        validators = validators or {}
+        by_host = defaultdict(list)
+        for url in set(urls):
+            by_host[urlsplit(url).netloc].append(url)
+        # Interleave hosts so that workers don't all wait on the same host limit
+        ordered = [url for url in itertools.chain(*itertools.zip_longest(*by_host.values())) if url]
+        results = {}
+        self.errors = {}
+        self.responses = {}
+        stats = defaultdict(lambda: {'done': 0, 'failed': 0, 'not_modified': 0, 'bytes': 0, 'seconds': 0.0})
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            fetched = executor.map(self._fetch, ordered, [validators.get(url) for url in ordered])
+            for url, (host, response, error, seconds) in zip(ordered, fetched):
+                results[url] = response and response['data']
+                host_stats = stats[host]
+                host_stats['seconds'] += seconds
+                if error:
+                    self.errors[url] = str(error)
+                    host_stats['failed'] += 1
+                    _logger.warning(str(error))
+                else:
+                    host_stats['done'] += 1
+                    if 'etag' in response:
+                        self.responses[url] = response
+                    if response['data'] is NOT_MODIFIED:
+                        host_stats['not_modified'] += 1
+                    else:
+                        host_stats['bytes'] += len(response['data']) * 3 // 4
+        elapsed = time.perf_counter() - start
+        done = sum(s['done'] for s in stats.values())
+        _logger.info(f'Fetched {done}/{len(ordered)} images in {elapsed:.1f}s.')
+        for host, host_stats in stats.items():
+            _logger.info(
+                f"  {host or 'no host'}: {host_stats['done']} done ({host_stats['not_modified']} not modified), {host_stats['failed']} failed, "
+                f"{host_stats['done'] / elapsed if elapsed else 0:.1f} images/s, "
+                f"{host_stats['bytes'] / 1024 / elapsed if elapsed else 0:.0f} kB/s, "
+                f"{host_stats['seconds'] / (host_stats['done'] + host_stats['failed']):.2f}s per image"
+            )
+        return results
+
+    def close(self):
+        self.session.close()
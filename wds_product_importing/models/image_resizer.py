@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from odoo.tools import image_process
+
+_logger = logging.getLogger(__name__)
+
+# Sizes of the image.mixin fields, image_1920 first since the smaller ones are computed from it
+IMAGE_SIZES = (1920, 1024, 512, 256, 128)
+
+
+def resize_image(data, sizes=IMAGE_SIZES):
+    ''' Return {size: base64 image} for a base64 image, resized the way the image_<size> fields of
+    image.mixin would. This only does CPU work, so it can run in another process. '''
+    image_1920 = image_process(data, size=(1920, 1920), verify_resolution=True)
+    resized = {1920: image_1920}
+    for size in sizes:
+        if size != 1920:
+            resized[size] = image_process(image_1920, size=(size, size))
+    return resized
+
+
+def try_resize_image(data, sizes=IMAGE_SIZES):
+    ''' Like resize_image, but return a (resized, error) pair instead of raising, so that one broken image
+    (e.g. a truncated file whose header still opens) doesn't abort the resize of the others. '''
+    try:
+        return resize_image(data, sizes), None
+    except Exception as e:
+        return None, str(e) or e.__class__.__name__
+
+
+class ImageResizer:
+    ''' Resizes batches of images in a pool of forked processes, outside of the cron worker's thread.
+
+    With no workers, images are resized in the current process.
+    '''
+
+    def __init__(self, workers=0, sizes=IMAGE_SIZES):
+        # image_1920 is always stored, the other sizes only when asked for
+        self.sizes = tuple(size for size in sizes if size in IMAGE_SIZES and size != 1920)
+        self.executor = None
+        if workers:
+            # The children only run resize_image and never touch the parent's database connections
+            self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+
+    def resize(self, images):
+        ''' Resize a list of base64 images, returning a list of ({size: base64 image}, None) pairs, or
+        (None, error message) for the images that could not be resized. '''
+        start = time.perf_counter()
+        sizes = [self.sizes] * len(images)
+        if self.executor and len(images) > 1:
+            results = list(self.executor.map(try_resize_image, images, sizes, chunksize=8))
+        else:
+            results = list(map(try_resize_image, images, sizes))
+        if images:
+            elapsed = time.perf_counter() - start
+            _logger.info(f'Resized {len(images)} images in {elapsed:.1f}s ({len(images) / elapsed if elapsed else 0:.1f} images/s).')
+        return results
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
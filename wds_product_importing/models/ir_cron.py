@@ -49,8 +49,8 @@ class ir_cron(models.Model):
                 if job['id'] == cron.env.ref('wds_product_importing.cron_import_product_documents', raise_if_not_found=False).id and len(cron.env.company.import_folder.document_ids):
                     # update next call to 3 minutes if documents still remain in import folder
                     nextcall = datetime.now() + timedelta(minutes=3)
-                if job['id'] == cron.env.ref('wds_product_importing.cron_import_images', raise_if_not_found=False).id and cron.env['product.template'].search([('image_updated','=',True),('image_failed','=',False)], limit=1):
-                    # update next call to 3 minutes if documents still remain in import folder
+                if job['id'] == cron.env.ref('wds_product_importing.cron_import_images', raise_if_not_found=False).id and cron.env['product.image.job']._has_pending():
+                    # update next call to 3 minutes if images are still queued, including the ones waiting to be retried
                     nextcall = datetime.now() + timedelta(minutes=3)
                 cron_cr.execute("UPDATE ir_cron SET nextcall=%s, numbercall=%s, lastcall=%s"+addsql+" WHERE id=%s",(
                     fields.Datetime.to_string(nextcall.astimezone(pytz.UTC)),
@@ -14,18 +14,21 @@ class Http(models.AbstractModel):
                 obj = self._xmlid_to_obj(self.env, xmlid)
             elif id and model in self.env:
                 obj = self.env[model].browse(int(id))
-            if obj.image_updated or (not obj[field] and obj.image_url):
+            image_field = 'image_1920' if field.startswith('image_') else field
+            # Sizes left out of image_sizes are never stored, serve the next larger one instead
+            if obj and image_field != field and not obj[field] and obj.image_1920:
+                field = self.env['product.template']._get_served_image_field(field)
+            # Only a missing image_1920 means the image wasn't downloaded yet
+            if obj and (obj.image_updated or (not obj[image_field] and obj.image_url)):
                 obj = obj.with_context(active_test=False, prefetch_fields=False, mail_notrack=True, tracking_disable=True, mail_activity_quick_update=False).sudo()
                 if obj._name == 'product.product':
                     obj = obj.product_tmpl_id
-                obj._import_single_image()
-                # try:
-                #     obj.image_1920 = obj._import_image_cached(obj.image_url, obj.id)
-                #     obj.image_updated = False
-                #     obj.image_failed = False
-                # except Exception as e:
-                #     obj.image_1920 = self.env.company.logo
-                #     obj.image_failed = True
+                if obj.env.company.image_fetch_mode == 'inline':
+                    obj._import_single_image()
+                else:
+                    # Never block the request on the vendor: use the cached image if we have one,
+                    # otherwise the placeholder is served while the image downloads in the background.
+                    obj._import_cached_image_or_enqueue()
 
         return super().binary_content(
             xmlid=xmlid, model=model, id=id, field=field, unique=unique, filename=filename,
@@ -15,9 +15,12 @@ class ProductProduct(models.Model):
     unit = fields.Char(string='Unit')
     unitqty = fields.Char(string='Unit Quantity')
     base_list_price = fields.Float(string='Variant Base Price')
+    # Copy of standard_price that SQL queries can read straight from product_product instead of ir_property
+    base_cost = fields.Float(string='Variant Base Cost', digits='Product Price', readonly=True, copy=False)
     to_remove = fields.Boolean(string='To Remove', default=False)
     
     attachment_id = fields.Many2one(comodel_name='ir.attachment')
+    import_generation = fields.Integer(string='Import Generation', readonly=True, copy=False, index=True)
     lst_price = fields.Float(store=True)
     
     @api.depends('list_price', 'base_list_price')
@@ -35,6 +38,20 @@ class ProductProduct(models.Model):
                 list_price = price
             product.lst_price = list_price
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        for vals in vals_list:
+            if 'standard_price' in vals:
+                vals['base_cost'] = vals['standard_price']
+        return super(ProductProduct, self).create(vals_list)
+
+    def write(self, vals):
+        if 'standard_price' in vals:
+            vals = dict(vals, base_cost=vals['standard_price'])
+        if 'active' in vals:
+            self.env['product.template.attribute.value']._invalidate_active_variant_values()
+        return super(ProductProduct, self).write(vals)
+
     def price_compute(self, price_type, uom=False, currency=False, company=None):
         res = super(ProductProduct, self).price_compute(price_type, uom, currency, company)
         products = self
@@ -2,6 +2,7 @@
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
 from odoo import models, fields, api
+from odoo.http import request
 
 
 class ProductTemplateAttributeValue(models.Model):
@@ -9,11 +10,44 @@ class ProductTemplateAttributeValue(models.Model):
 
     def _only_active_wds(self):
         res = super(ProductTemplateAttributeValue, self)._only_active()
-        # only single combination variants so mapped will always be len 1 array, use any() just in case
-        # hides variant if product has to_remove or is archived
-        hidden_variants = self.env['product.template.attribute.value']
-        for val in res:
-            if not len(val.ptav_product_variant_ids):
-                hidden_variants += val
-        res -= hidden_variants
-        return res
+        # hides values without any active variant, i.e. whose variant was archived by the import
+        active_ids = self._get_active_variant_value_ids(res.product_tmpl_id.ids)
+        return res.filtered(lambda val: val.id in active_ids)
+
+    @api.model
+    def _get_active_variant_value_ids(self, template_ids):
+        ''' Return the ids of the attribute values of the given templates used by at least one active
+        variant, with one query per template and request (the website renders them several times). '''
+        cache = getattr(request, '_wds_active_variant_values', None) if request else None
+        if cache is None:
+            cache = {}
+            if request:
+                request._wds_active_variant_values = cache
+        missing = [template_id for template_id in template_ids if template_id not in cache]
+        if missing:
+            self.flush(['ptav_product_variant_ids'])
+            self.env['product.product'].flush(['active', 'product_tmpl_id'])
+            self._cr.execute('''
+                SELECT
+                    product_product.product_tmpl_id,
+                    ARRAY_AGG(DISTINCT product_variant_combination.product_template_attribute_value_id)
+                FROM
+                    product_product
+                    JOIN product_variant_combination ON product_variant_combination.product_product_id = product_product.id
+                WHERE
+                    product_product.product_tmpl_id IN %s
+                    AND product_product.active
+                GROUP BY
+                    product_product.product_tmpl_id
+            ''', (tuple(missing), ))
+            for template_id in missing:
+                cache[template_id] = set()
+            for template_id, value_ids in self._cr.fetchall():
+                cache[template_id] = set(value_ids)
+        return set().union(*(cache[template_id] for template_id in template_ids))
+
+    @api.model
+    def _invalidate_active_variant_values(self):
+        ''' Forget the active values cached for the current request, after variants were (un)archived. '''
+        if request and hasattr(request, '_wds_active_variant_values'):
+            del request._wds_active_variant_values
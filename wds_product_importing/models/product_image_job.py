@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import logging
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+# Failed downloads are retried after 5, 10, 20, 40 minutes... and given up after MAX_ATTEMPTS tries
+RETRY_DELAY_MINUTES = 5
+MAX_ATTEMPTS = 5
+# Jobs claimed longer than this ago belong to a worker that died, they can be claimed again
+CLAIM_TIMEOUT_MINUTES = 30
+
+
+class ProductImageJob(models.Model):
+    _name = 'product.image.job'
+    _description = 'Product Image Download'
+    _order = 'priority desc, id'
+
+    product_tmpl_id = fields.Many2one('product.template', required=True, ondelete='cascade', index=True)
+    priority = fields.Integer(default=0, help='Jobs with a higher priority are downloaded first.')
+    state = fields.Selection([
+        ('pending', 'Pending'),
+        ('in_flight', 'Downloading'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ], default='pending', required=True, index=True)
+    attempts = fields.Integer(default=0, help='Number of downloads tried since the job was queued.')
+    next_attempt = fields.Datetime(default=fields.Datetime.now, index=True, help='The job is not claimed before this date.')
+    claimed_at = fields.Datetime(help='When a worker started downloading the image.')
+    last_error = fields.Char()
+
+    _sql_constraints = [
+        ('product_tmpl_uniq', 'unique (product_tmpl_id)', 'A product can only be queued once for image download.')
+    ]
+
+    @api.model
+    def _enqueue(self, template_ids, priority=0, reset=False, wake_up=True):
+        ''' Queue products for image download. Products already queued are only bumped to the higher
+        priority, so concurrent requests for the same product never queue it twice. Jobs that are done
+        are queued again; failed jobs only are when `reset` is set (the image url changed), which also
+        restarts the retries of pending jobs. The image cron is woken up unless `wake_up` is False.
+
+        Returns the number of products that were newly queued, requeued or bumped.
+        '''
+        if not template_ids:
+            return 0
+        self._cr.execute('''
+            INSERT INTO product_image_job (product_tmpl_id, priority, state, attempts, next_attempt, create_date, write_date)
+            SELECT id, %(priority)s, 'pending', 0, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+            FROM unnest(%(template_ids)s) AS id
+            ON CONFLICT (product_tmpl_id) DO UPDATE SET
+                priority = CASE WHEN product_image_job.state IN ('pending', 'in_flight')
+                    THEN GREATEST(product_image_job.priority, EXCLUDED.priority) ELSE EXCLUDED.priority END,
+                state = CASE WHEN %(reset)s OR product_image_job.state = 'done'
+                    THEN 'pending' ELSE product_image_job.state END,
+                attempts = CASE WHEN %(reset)s OR product_image_job.state = 'done'
+                    THEN 0 ELSE product_image_job.attempts END,
+                next_attempt = CASE WHEN %(reset)s OR product_image_job.state = 'done'
+                    THEN EXCLUDED.next_attempt ELSE product_image_job.next_attempt END,
+                write_date = EXCLUDED.write_date
+            WHERE
+                %(reset)s
+                OR product_image_job.state = 'done'
+                OR (product_image_job.state IN ('pending', 'in_flight') AND product_image_job.priority < EXCLUDED.priority)
+        ''', {'template_ids': list(template_ids), 'priority': priority, 'reset': reset})
+        queued = self._cr.rowcount
+        if queued and wake_up:
+            self._wake_up_cron()
+        return queued
+
+    @api.model
+    def _wake_up_cron(self):
+        ''' Move the next call of the image cron to now. A running cron keeps its row locked: it is left
+        alone, since it reschedules itself in a few minutes while jobs are pending. '''
+        cron = self.env.ref('wds_product_importing.cron_import_images', raise_if_not_found=False)
+        if not cron:
+            return
+        self._cr.execute('''
+            UPDATE ir_cron
+            SET nextcall = NOW() AT TIME ZONE 'UTC'
+            WHERE id IN (
+                SELECT id FROM ir_cron
+                WHERE id = %s AND nextcall > NOW() AT TIME ZONE 'UTC'
+                FOR NO KEY UPDATE SKIP LOCKED
+            )
+        ''', (cron.id, ))
+
+    @api.model
+    def _enqueue_flagged(self):
+        ''' Queue products flagged as needing their image without a job yet, e.g. flagged before the queue existed. '''
+        self._cr.execute('''
+            INSERT INTO product_image_job (product_tmpl_id, priority, state, attempts, next_attempt, create_date, write_date)
+            SELECT id, 0, 'pending', 0, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+            FROM product_template
+            WHERE image_updated AND NOT image_failed AND image_url IS NOT NULL AND image_url <> ''
+            ON CONFLICT (product_tmpl_id) DO NOTHING
+        ''')
+        return self._cr.rowcount
+
+    @api.model
+    def _claim(self, limit):
+        ''' Mark the next due jobs as downloading and return them. Jobs locked by another worker are
+        skipped, so several workers can drain the queue at the same time. The caller should commit
+        right away so that the claim is visible to the other workers.
+
+        Jobs left downloading by a worker that died are claimed again, unless they already used all their
+        attempts: those are given up, so that an image crashing its worker doesn't hold the queue forever. '''
+        self._cr.execute('''
+            UPDATE product_image_job
+            SET
+                state = 'failed',
+                last_error = 'Download interrupted too many times',
+                write_date = NOW() AT TIME ZONE 'UTC'
+            WHERE id IN (
+                SELECT id FROM product_image_job
+                WHERE
+                    state = 'in_flight'
+                    AND claimed_at < NOW() AT TIME ZONE 'UTC' - INTERVAL '1 minute' * %s
+                    AND attempts >= %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING product_tmpl_id
+        ''', (CLAIM_TIMEOUT_MINUTES, MAX_ATTEMPTS))
+        given_up = [row[0] for row in self._cr.fetchall()]
+        if given_up:
+            _logger.warning(f'Giving up the image download of products {given_up} after {MAX_ATTEMPTS} interrupted attempts.')
+            self.env['product.template'].browse(given_up)._set_image_failed()
+        self._cr.execute('''
+            UPDATE product_image_job
+            SET
+                state = 'in_flight',
+                attempts = attempts + 1,
+                claimed_at = NOW() AT TIME ZONE 'UTC',
+                write_date = NOW() AT TIME ZONE 'UTC'
+            WHERE id IN (
+                SELECT id FROM product_image_job
+                WHERE
+                    (state = 'pending' AND next_attempt <= NOW() AT TIME ZONE 'UTC')
+                    OR (state = 'in_flight' AND claimed_at < NOW() AT TIME ZONE 'UTC' - INTERVAL '1 minute' * %s)
+                ORDER BY priority DESC, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        ''', (CLAIM_TIMEOUT_MINUTES, limit))
+        return self.browse([row[0] for row in self._cr.fetchall()])
+
+    def _finish(self, errors, give_up=()):
+        ''' Close claimed jobs: the ones with an error in `errors` (by product id) are retried later with an
+        exponential backoff or given up after MAX_ATTEMPTS tries, right away for products in `give_up`.
+        The others are done. Jobs queued again while downloading are left pending. Returns the products
+        whose download was given up. '''
+        failed = self.filtered(lambda job: job.product_tmpl_id.id in errors)
+        done = self - failed
+        if done:
+            self._cr.execute('''
+                UPDATE product_image_job
+                SET state = 'done', last_error = NULL, write_date = NOW() AT TIME ZONE 'UTC'
+                WHERE id IN %s AND state = 'in_flight'
+            ''', (tuple(done.ids), ))
+        given_up = []
+        for job in failed:
+            self._cr.execute('''
+                UPDATE product_image_job
+                SET
+                    state = CASE WHEN attempts >= %(max_attempts)s OR %(give_up)s THEN 'failed' ELSE 'pending' END,
+                    next_attempt = NOW() AT TIME ZONE 'UTC' + INTERVAL '1 minute' * %(delay)s * POWER(2, GREATEST(attempts - 1, 0)),
+                    last_error = %(error)s,
+                    write_date = NOW() AT TIME ZONE 'UTC'
+                WHERE id = %(id)s AND state = 'in_flight'
+                RETURNING state
+            ''', {
+                'id': job.id,
+                'max_attempts': MAX_ATTEMPTS,
+                'give_up': job.product_tmpl_id.id in give_up,
+                'delay': RETRY_DELAY_MINUTES,
+                'error': (errors[job.product_tmpl_id.id] or '')[:255],
+            })
+            row = self._cr.fetchone()
+            if row and row[0] == 'failed':
+                given_up.append(job.product_tmpl_id.id)
+        self.invalidate_cache()
+        return self.env['product.template'].browse(given_up)
+
+    @api.model
+    def _has_pending(self):
+        ''' Whether jobs are waiting to be downloaded, now or after their retry delay. '''
+        self._cr.execute("SELECT 1 FROM product_image_job WHERE state IN ('pending', 'in_flight') LIMIT 1")
+        return bool(self._cr.fetchone())
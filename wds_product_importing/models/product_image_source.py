@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+from odoo import api, fields, models
+
+
+class ProductImageSource(models.Model):
+    _name = 'product.image.source'
+    _description = 'Product Image Source'
+    _rec_name = 'url'
+
+    url = fields.Char(required=True, index=True)
+    etag = fields.Char(string='ETag')
+    last_modified = fields.Char(string='Last Modified', help='Last-Modified header, as sent by the server.')
+    content_length = fields.Integer(string='Size (bytes)')
+    checksum = fields.Char(help='SHA-1 of the image last downloaded from this url, see product.template image_checksum.')
+
+    _sql_constraints = [
+        ('url_uniq', 'unique (url)', 'An image url can only be recorded once.')
+    ]
+
+    @api.model
+    def _get_validators(self, urls):
+        ''' Map urls to the validators of the image last downloaded from them, for conditional requests.
+        Only urls whose image is still stored on a product are returned, since a 304 answer is useless
+        without it. '''
+        if not urls:
+            return {}
+        self._cr.execute('''
+            SELECT DISTINCT ON (source.url)
+                source.url, source.etag, source.last_modified, source.checksum, product_template.id
+            FROM
+                product_image_source AS source
+                JOIN product_template ON product_template.image_checksum = source.checksum
+                JOIN ir_attachment ON
+                    ir_attachment.res_model = 'product.template'
+                    AND ir_attachment.res_field = 'image_1920'
+                    AND ir_attachment.res_id = product_template.id
+            WHERE
+                source.url IN %s
+                AND (source.etag IS NOT NULL OR source.last_modified IS NOT NULL)
+            ORDER BY
+                source.url, product_template.id
+        ''', (tuple(urls), ))
+        return {
+            url: {'etag': etag, 'last_modified': last_modified, 'checksum': checksum, 'product_id': product_id}
+            for url, etag, last_modified, checksum, product_id in self._cr.fetchall()
+        }
+
+    @api.model
+    def _record(self, responses, checksums):
+        ''' Store the validators the servers sent with the images downloaded from each url, along with
+        the checksum of each image. '''
+        rows = [
+            (url, response.get('etag'), response.get('last_modified'), response.get('content_length'), checksums[url])
+            for url, response in responses.items() if url in checksums
+        ]
+        if not rows:
+            return
+        self._cr.execute('''
+            INSERT INTO product_image_source (url, etag, last_modified, content_length, checksum, create_date, write_date)
+            SELECT url, etag, last_modified, content_length, checksum, NOW() AT TIME ZONE 'UTC', NOW() AT TIME ZONE 'UTC'
+            FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::integer[], %s::varchar[])
+                AS source(url, etag, last_modified, content_length, checksum)
+            ON CONFLICT (url) DO UPDATE SET
+                etag = EXCLUDED.etag,
+                last_modified = EXCLUDED.last_modified,
+                content_length = EXCLUDED.content_length,
+                checksum = EXCLUDED.checksum,
+                write_date = EXCLUDED.write_date
+        ''', [list(column) for column in zip(*rows)])
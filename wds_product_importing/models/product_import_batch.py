@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from .attachment import BigInteger
+
+# Stages of a batch, in the order they run, with the field storing their duration
+IMPORT_STAGES = ('parse', 'classify', 'update', 'create', 'variants', 'pricelists', 'list_price', 'search_text', 'commit')
+
+
+class StageTimer:
+    ''' Accumulates the wall time spent in each stage of an import batch.
+
+        with timer('parse'):
+            rows = reader.read(batch_size)
+    '''
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.timings = defaultdict(float)
+
+    @contextmanager
+    def __call__(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage] += time.perf_counter() - start
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+
+class ProductImportBatch(models.Model):
+    _name = 'product.import.batch'
+    _description = 'Product Import Batch'
+    _order = 'id desc'
+
+    document_id = fields.Many2one('documents.document', string='Document', ondelete='cascade', index=True, readonly=True)
+    batch = fields.Integer(string='Batch', readonly=True)
+    first_row = fields.Integer(string='First Row', readonly=True, help='Spreadsheet row of the first line of the batch.')
+    batch_offset = BigInteger(string='Next Offset', readonly=True, help='Where the next batch starts in the file.')
+    rows = fields.Integer(string='Rows', readonly=True)
+    created = fields.Integer(string='Created', readonly=True)
+    updated = fields.Integer(string='Updated', readonly=True)
+    unchanged = fields.Integer(string='Unchanged', readonly=True)
+    rows_per_second = fields.Float(string='Rows/s', readonly=True, digits=(16, 1))
+
+    parse_time = fields.Float(string='Parse (s)', readonly=True, digits=(16, 3))
+    classify_time = fields.Float(string='Classify (s)', readonly=True, digits=(16, 3))
+    update_time = fields.Float(string='Update (s)', readonly=True, digits=(16, 3))
+    create_time = fields.Float(string='Create (s)', readonly=True, digits=(16, 3))
+    variants_time = fields.Float(string='Variants (s)', readonly=True, digits=(16, 3))
+    pricelists_time = fields.Float(string='Pricelists (s)', readonly=True, digits=(16, 3))
+    list_price_time = fields.Float(string='List Price (s)', readonly=True, digits=(16, 3))
+    search_text_time = fields.Float(string='Search Text (s)', readonly=True, digits=(16, 3))
+    commit_time = fields.Float(string='Commit (s)', readonly=True, digits=(16, 3))
+    total_time = fields.Float(string='Total (s)', readonly=True, digits=(16, 3))
+
+    @api.model
+    def _record(self, document, timer, **values):
+        ''' Store the counts and stage timings of a batch, in the batch's own transaction. '''
+        total = timer.elapsed()
+        values.update({f'{stage}_time': timer.timings[stage] for stage in IMPORT_STAGES})
+        values.update({
+            'document_id': document.id,
+            'total_time': total,
+            'rows_per_second': values.get('rows', 0) / total if total else 0,
+        })
+        return self.sudo().create(values)
+
+    def _record_commit(self, timer):
+        ''' The commit stage is only known once the batch is committed: write it in a transaction of its own. '''
+        self._cr.execute('''
+            UPDATE product_import_batch
+            SET commit_time = %s, total_time = total_time + %s
+            WHERE id = %s
+        ''', (timer.timings['commit'], timer.timings['commit'], self.id))
+        self._cr.commit()
+
+    @api.autovacuum
+    def _gc_import_batches(self):
+        ''' Only keep three months of import statistics. '''
+        self.sudo().search([('create_date', '<', fields.Datetime.now() - timedelta(days=90))]).unlink()
@@ -1,42 +1,173 @@
 # -*- coding: utf-8 -*-
 # Part of Odoo. See LICENSE file for full copyright and licensing details.
 
+import base64
+import hashlib
+import io
 import itertools
 import logging
-import math
+import os
 import threading
-from datetime import datetime, timedelta
+from collections import Counter, defaultdict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from decimal import Decimal
 
 import requests
 from odoo import _, fields, models, api, tools
-from psycopg2.extras import execute_values
+from odoo.addons.base_import.models.base_import import DEFAULT_IMAGE_TIMEOUT, DEFAULT_IMAGE_MAXBYTES
+from odoo.tools import config
+from .image_cache import get_image_cache
+from .image_fetcher import NOT_MODIFIED, ImageFetcher, fetch_image
+from .image_resizer import IMAGE_SIZES, ImageResizer
+from .attachment import FilestoreWriter, csv_record
+from .product_import_batch import StageTimer
 from .sql_queries import _queries 
 _logger = logging.getLogger(__name__)
 
 
-def clean_data_row(row_dict, field_mapping):
-    ''' Remove unused columns and replaces column names with field names. Set empty values to None. 
-    
-    We don't omit blank values to keep a consistent data structure for the SQL injection. Default
-    values of 0 and '' are used instead of None so that the data type for the column can be inferred.
+def _clean_number(cast):
+    def clean(value):
+        return cast(value) if value else 0
+    return clean
+
+
+# Characters that can appear in a string accepted by int(). Ascii strings with any other character
+# are returned as is without paying for the exception raised by int().
+_INT_CHARS = frozenset('0123456789+-_ \t\n\r\x0b\x0c')
+
+
+def _clean_text(value):
+    if not value:
+        return value
+    if isinstance(value, str) and value.isascii() and not _INT_CHARS.issuperset(value):
+        return value
+    try:
+        return str(int(value))
+    except Exception:
+        return str(value)
+
+
+_column_cleaners = {
+    'float': _clean_number(float),
+    'monetary': _clean_number(float),
+    'int': _clean_number(int),
+    'text': _clean_text,
+    'char': _clean_text,
+    'html': _clean_text,
+}
+
+
+# Compiled mapping of a header row: for each imported field, the header and position of its column and
+# the function coercing its values (None when values are kept as is)
+ColumnPlan = namedtuple('ColumnPlan', ['fields', 'headers', 'indices', 'cleaners'])
+
+
+def compile_column_plan(field_mapping, headers):
+    ''' Turn a mapping from _get_fields_column_mapping into a ColumnPlan for rows given as lists. '''
+    positions = {header: index for index, header in enumerate(headers)}
+    fields = tuple(field_mapping)
+    return ColumnPlan(
+        fields=fields,
+        headers=tuple(field_mapping[field]['name'] for field in fields),
+        indices=tuple(positions[field_mapping[field]['name']] for field in fields),
+        cleaners=tuple(_column_cleaners.get(field_mapping[field]['type']) for field in fields),
+    )
+
+
+def clean_data_batch(rows, plan, first_row=0):
+    ''' Coerce a whole batch of list rows one column at a time, following a ColumnPlan. Numbers are cast,
+    with 0 for empty cells so that the column type can be inferred, and text holding an integer is
+    written without its decimals.
+
+    Returns the cleaned rows as tuples in the order of plan.fields, and the list of (row number, column, value, error) for the cells that could not be coerced. Rows
+    with such errors are left out instead of failing the whole batch. Row numbers count the header as
+    row 1.
     '''
-    cleaned_dict = {}
-    for field, vals in field_mapping.items():
-        value = row_dict[vals['name']]
-        if value:
-            if vals['type'] in ['float', 'monetary']:
-                value = float(value)
-            elif vals['type'] in ['int']:
-                value = int(value)
-            elif vals['type'] in ['text','char','html']:
-                try:
-                    value = str(int(value))
-                except Exception:
-                    value = str(value)
-        elif vals['type'] in ['float', 'monetary', 'int']:
-            value = 0
-        cleaned_dict[field] = value
-    return cleaned_dict
+    columns = []
+    errors = []
+    for header, index, cleaner in zip(plan.headers, plan.indices, plan.cleaners):
+        column = [row[index] for row in rows]
+        if cleaner:
+            try:
+                column = list(map(cleaner, column))
+            except Exception:
+                column = list(column)
+                for idx, value in enumerate(column):
+                    try:
+                        column[idx] = cleaner(value)
+                    except Exception as e:
+                        column[idx] = None
+                        errors.append((first_row + idx + 2, header, value, str(e)))
+        columns.append(column)
+    cleaned_rows = list(zip(*columns)) if columns else [() for row in rows]
+    if errors:
+        invalid = {row_number - first_row - 2 for row_number, *_error in errors}
+        cleaned_rows = [row for idx, row in enumerate(cleaned_rows) if idx not in invalid]
+    return cleaned_rows, errors
+
+
+def row_hasher(fields):
+    ''' Return a function fingerprinting tuple rows of `fields`, used to skip rows that didn't change since
+    the last import. The fingerprint is the md5 of the (field, value) pairs sorted by field, the format
+    stored by earlier imports, so changing it would make every product look changed once. '''
+    order = sorted(range(len(fields)), key=fields.__getitem__)
+
+    def hash_row(row):
+        content = repr([(fields[index], row[index]) for index in order])
+        return hashlib.md5(content.encode('utf-8')).hexdigest()
+    return hash_row
+
+
+# Rows sharing one tuple of field names: a list of tuples for new products, a dict of tuples by id for
+# existing ones
+ImportRows = namedtuple('ImportRows', ['fields', 'rows'])
+
+
+def _value_changed(old, new):
+    ''' Compare a value read from the database with the imported one, ignoring float/numeric differences. '''
+    if isinstance(old, (float, Decimal)) or isinstance(new, (float, Decimal)):
+        try:
+            return float(old or 0) != float(new or 0)
+        except (TypeError, ValueError):
+            pass
+    return old != new
+
+
+# Bounds of the batch sizes picked by next_batch_size
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 20000
+
+
+def next_batch_size(size, rows, seconds, target):
+    ''' Size of the next import batch so that it takes about `target` seconds, given that the last one
+    imported `rows` rows in `seconds`. The size changes by a factor of 2 at most per batch so that a
+    single slow or fast batch doesn't throw it off. '''
+    if not rows or seconds <= 0 or target <= 0:
+        return size
+    wanted = rows / seconds * target
+    wanted = min(max(wanted, size / 2), size * 2)
+    return int(min(max(wanted, MIN_BATCH_SIZE), MAX_BATCH_SIZE))
+
+
+# Key of the advisory lock serializing the creation of records shared by parallel import workers
+_SHARED_RECORDS_LOCK = 2420357
+
+
+def _import_timed_out():
+    ''' Whether the cron that started the import ran out of time. Import worker threads check the cron thread. '''
+    thread = threading.current_thread()
+    return getattr(getattr(thread, 'import_thread', thread), 'timed_out', False)
+
+
+def _copy_value(value):
+    ''' Format a python value for the text format of COPY FROM STDIN. '''
+    if value is None:
+        return '\\N'
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, str):
+        return value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+    return str(value)
 
 
 class ProductTemplateAttributeLine(models.Model):
@@ -67,6 +198,8 @@ class ProductTemplate(models.Model):
     image_url = fields.Char(string="IMAGE")
     image_updated = fields.Boolean(string="Image Needs Downloading", default=False, readonly=True, index=True)
     image_failed = fields.Boolean(string="Image Import Failed", default=False, readonly=True, index=True)
+    image_checksum = fields.Char(string="Image Checksum", readonly=True, copy=False, index=True,
+                                 help="SHA-1 of the downloaded image. Products with the same image share its attachments.")
     product_url = fields.Char(string='PRODUCT URL')
     weblink = fields.Char(string='ADDITIONAL WEBLINK')
     weblink_title = fields.Char(string='ADDITIONAL WEBLINK_TITLE')
@@ -101,6 +234,47 @@ class ProductTemplate(models.Model):
 
     to_remove = fields.Boolean(string='To Remove', default=False)
     attachment_id = fields.Many2one(comodel_name='ir.attachment', index=True)
+    import_hash = fields.Char(string='Import Fingerprint', readonly=True, copy=False)
+    import_generation = fields.Integer(string='Import Generation', readonly=True, copy=False, index=True)
+    website_search_text = fields.Text(string='Website Search Text', compute='_compute_website_search_text', store=True, copy=False,
+                                      help='Names, descriptions and catalog/manufacturer numbers searched by the shop, indexed with trigrams.')
+    website_search_name = fields.Text(string='Website Search Name', compute='_compute_website_search_text', store=True, copy=False,
+                                      help='Names and catalog/manufacturer numbers searched by the shop when descriptions are left out, indexed with trigrams.')
+
+    def init(self):
+        super().init()
+        # A trigram index lets ilike '%...%' on the search columns use an index instead of a sequential scan
+        try:
+            with self._cr.savepoint():
+                self._cr.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        except Exception as e:
+            _logger.warning(f'Could not install the pg_trgm extension, the website search will not be indexed: {e}')
+            return
+        for column in ('website_search_text', 'website_search_name'):
+            self._cr.execute(f'''
+                CREATE INDEX IF NOT EXISTS product_template_{column}_trgm_idx
+                ON product_template USING gin ({column} gin_trgm_ops)
+            ''')
+
+    @api.depends('name', 'description', 'description_sale', 'product_code', 'mfr_num', 'mfr_name')
+    def _compute_website_search_text(self):
+        ''' Search text of the shop. Translations that differ from the source value are appended after it,
+        by field then language, so that a product is also found by its translated name in any language. '''
+        # Keep in sync with _queries['write_website_search_text'], used by the import
+        langs = sorted(code for code, name in self.env['res.lang'].get_installed() if code != 'en_US')
+        for product in self.with_context(lang='en_US'):
+            translations = {}
+            for fname in ('description', 'description_sale', 'name'):
+                translations[fname] = [
+                    value for value in (product.with_context(lang=lang)[fname] for lang in langs)
+                    if value and value != product[fname]
+                ]
+            codes = (product.product_code, product.mfr_num, product.mfr_name)
+            name_parts = (product.name, *codes, *translations['name'])
+            text_parts = (product.name, *codes, product.description, product.description_sale,
+                          *translations['description'], *translations['description_sale'], *translations['name'])
+            product.website_search_name = ' '.join(part for part in name_parts if part) or False
+            product.website_search_text = ' '.join(part for part in text_parts if part) or False
 
     '''
     import all products from documents in the designated product folder then move attachment to different folder
@@ -142,93 +316,372 @@ class ProductTemplate(models.Model):
         if not documents:
             return
         _logger.info('Importing documents')
-        self = self.with_context(active_test=False, prefetch_fields=False, mail_notrack=True, tracking_disable=True, mail_activity_quick_update=False)
         company = self.company_id or self.env.company
+        # Every product seen by this run is stamped with its generation, the others are stale once it's done
+        generation = company.import_generation + 1
+        self = self.with_context(active_test=False, prefetch_fields=False, mail_notrack=True, tracking_disable=True, mail_activity_quick_update=False, import_generation=generation)
         failed_imports = self.env['documents.document']
-        for doc in documents.with_context(prefetch_fields=False):
-            doc._prefetch_ids = doc._ids
-            # Get first rows in dictionary form
-            data_rows = doc.attachment_id._read_as_dict_list(0, 1)
-            # Get table column header to field mapping
-            field_mapping = self._get_fields_column_mapping(next(data_rows).keys())
-            del data_rows
-            if self.user_has_groups('base.group_no_one'):
-                doc.attachment_id.batch = 0 # Useful for debugging. This lets you reuse the same document repeatedly.
-            while True:
-                try:
-                    if threading.current_thread().timed_out:
-                        return False
-                except AttributeError:  # timed_out won't exist if launched from action menu and not cron
-                    pass
-                batch = doc.attachment_id.batch
-                try:
-                    batched_rows = doc.attachment_id._read_as_dict_list( batch_size*doc.attachment_id.batch, batch_size*(doc.attachment_id.batch + 1))
-                    to_create, to_update = self.with_context(attachment_id=doc.attachment_id.id)._split_rows_into_new_and_existing_products(batched_rows, field_mapping)
-                    if len(to_create)==0 and len(to_update) == 0:
-                        break
-                    # Update existing
-                    updated_products = self._optimized_update(to_update)
-                    # Create new
-                    new_product_templates = self._optimized_create(to_create) 
-                    # Post-processing
-                    ## Write attachment_id to product variants that don't need updating so that they won't get archived later
-                    updated_products['updated_products'].write({'attachment_id': doc.attachment_id.id})
-                    updated_products['no_new_variants'].mapped('product_variant_ids').filtered(lambda p: p.active).write({'attachment_id': doc.attachment_id.id})
-                    ## Enable dropshipping on products
-                    new_product_templates.enable_dropshipping()
-                    ## Flag products to update images
-                    (new_product_templates + updated_products['to_update_images']).write({'image_updated': True})
-                    ## Create / update variants
-                    products_to_update_variants = new_product_templates + updated_products['to_update_variants']
-                    # all_products = new_product_templates + updated_products['updated_products']
-                    if (products_to_update_variants):
-                        products_to_update_variants.with_context(attachment_id=doc.attachment_id.id)._update_product_variants()
-                        products_to_update_variants._update_pricelists()
-                        products_to_update_variants._set_list_price()
-                    # Increase batch
-                    _logger.info(f'Importing batch #{doc.attachment_id.batch} from {doc.attachment_name} done. {len(new_product_templates)} products created. {len(updated_products["to_update_variants"])} products updated.')
-                    doc.attachment_id.batch += 1
-                    self._cr.commit()
-                except Exception as e:
-                    _logger.error(f"There was an error somewhere in file {doc.attachment_name} between rows {batch_size * batch + 2} and {batch_size*(batch + 1) + 2}.\nError: {e}")
-                    self._cr.rollback()
-                    failed_imports += doc
+        workers = min(company.import_workers, len(documents))
+        if workers > 1:
+            results = self._import_documents_parallel(documents, batch_size, workers)
+        else:
+            results = {}
+            for doc in documents.with_context(prefetch_fields=False):
+                doc._prefetch_ids = doc._ids
+                results[doc.id] = self._import_document(doc, batch_size)
+                if results[doc.id] == 'timeout':
                     break
-            doc.invalidate_cache()
+        # Download the images queued by the committed batches, even if the import didn't finish
+        self.env['product.image.job']._wake_up_cron()
+        self._cr.commit()
+        if 'timeout' in results.values():
+            return False
+        failed_imports = documents.filtered(lambda doc: results.get(doc.id) == 'failed')
 
         if not failed_imports:
             _logger.info('Data import done! Handling stale products now.')
-            self._handle_stale_products(documents)
+            self._handle_stale_products(generation)
+            company.import_generation = generation
             documents.folder_id = company.complete_import_folder
             documents._cr.commit()
             _logger.info('Import done!')
-            try:
-                self.env.ref('wds_product_importing.cron_import_images').nextcall = datetime.now() + timedelta(minutes=5)
-            except Exception:
-                pass
         else:
             _logger.error(f"The following document ids failed to import fully: {failed_imports.ids}")
 
         return True
 
-    def _handle_stale_products(self, documents):
+    def _import_documents_parallel(self, documents, batch_size, workers):
+        ''' Import several documents at once, each one in its own thread with its own cursor.
+
+        Attribute values and vendors are shared between documents, so workers create and commit them
+        before each batch, taking turns through an advisory lock (see _create_shared_import_records),
+        instead of inside their batch, where concurrent inserts of the same rows could deadlock. Returns the
+        status of each document, by id.
+        '''
+        self._cr.commit()
+        parent_thread = threading.current_thread()
+        _logger.info(f'Importing {len(documents)} documents with {workers} workers')
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            statuses = executor.map(
+                lambda doc_id: self._import_document_in_worker(doc_id, batch_size, parent_thread),
+                documents.ids
+            )
+            results = dict(zip(documents.ids, statuses))
+        documents.invalidate_cache()
+        return results
+
+    def _import_document_in_worker(self, document_id, batch_size, parent_thread):
+        threading.current_thread().import_thread = parent_thread
+        try:
+            with api.Environment.manage(), self.pool.cursor() as cr:
+                env = api.Environment(cr, self.env.uid, dict(self.env.context, import_parallel=True))
+                document = env['documents.document'].browse(document_id)
+                return env['product.template']._import_document(document, batch_size)
+        except Exception as e:
+            _logger.error(f'Import worker failed on document {document_id}.\nError: {e}')
+            return 'failed'
+
+    def _import_document(self, doc, batch_size):
+        ''' Import one document batch by batch, committing after each batch.
+
+        Returns 'done', 'failed' or 'timeout' when the cron ran out of time.
+        '''
+        attachment = doc.attachment_id
         company = self.company_id or self.env.company
+        if self.user_has_groups('base.group_no_one'):
+            # Useful for debugging. This lets you reuse the same document repeatedly.
+            attachment.write({'batch': 0, 'batch_offset': 0, 'batch_row': 0})
+        # Parse the file once and resume from where the last run stopped
+        reader = attachment._get_spreadsheet_reader(attachment.batch_offset)
+        if reader is None:
+            return 'failed'
+        with reader:
+            # Get the compiled column plan, shared by every file with the same header row
+            column_plan = self._get_column_plan(tuple(reader.headers))
+            # Resume with the size tuned by the previous run of this file
+            batch_size = attachment.import_batch_size or batch_size
+            while True:
+                if _import_timed_out():
+                    return 'timeout'
+                batch = attachment.batch
+                first_row = attachment.batch_row
+                timer = StageTimer()
+                try:
+                    with timer('parse'):
+                        batched_rows = reader.read(batch_size)
+                    if not batched_rows:
+                        break
+                    with timer('classify'):
+                        cleaned_rows = self._clean_rows(batched_rows, column_plan, first_row)
+                        if self.env.context.get('import_parallel'):
+                            # Committed before the batch's first query, so that its snapshot sees them
+                            self._create_shared_import_records(cleaned_rows, column_plan.fields)
+                        to_create, to_update, unchanged = self.with_context(attachment_id=attachment.id)._split_cleaned_rows(cleaned_rows, column_plan)
+                    with timer('update'):
+                        # Rows identical to the last import only need to be marked as still present
+                        self.browse(unchanged).with_context(attachment_id=attachment.id)._mark_unchanged_products()
+                        # Update existing
+                        updated_products = self._optimized_update(to_update)
+                        ## Write attachment_id to product variants that don't need updating so that they won't get archived later
+                        stamp = {'attachment_id': attachment.id, 'import_generation': self.env.context.get('import_generation')}
+                        updated_products['updated_products'].write(stamp)
+                        updated_products['no_new_variants'].mapped('product_variant_ids').filtered(lambda p: p.active).write(stamp)
+                    with timer('create'):
+                        # Create new
+                        new_product_templates = self._optimized_create(to_create) 
+                        # Post-processing
+                        ## Enable dropshipping on products
+                        new_product_templates.enable_dropshipping()
+                        ## Flag products to update images
+                        images_to_update = new_product_templates + updated_products['to_update_images']
+                        images_to_update.write({'image_updated': True})
+                        # The image cron is woken up once the documents are imported
+                        self.env['product.image.job']._enqueue(images_to_update.ids, reset=True, wake_up=False)
+                    ## Create / update variants
+                    products_to_update_variants = new_product_templates + updated_products['to_update_variants']
+                    # all_products = new_product_templates + updated_products['updated_products']
+                    if (products_to_update_variants):
+                        with timer('variants'):
+                            products_to_update_variants.with_context(attachment_id=attachment.id)._update_product_variants()
+                        with timer('pricelists'):
+                            products_to_update_variants._update_pricelists()
+                        with timer('list_price'):
+                            products_to_update_variants._set_list_price()
+                        with timer('search_text'):
+                            products_to_update_variants._update_website_search_text()
+                    # Increase batch and remember where the next one starts
+                    _logger.info(f'Importing batch #{batch} from {doc.attachment_name} done. {len(new_product_templates)} products created. {len(updated_products["to_update_variants"])} products updated. {len(unchanged)} products unchanged.')
+                    next_size = next_batch_size(batch_size, len(batched_rows), timer.elapsed(), company.import_batch_seconds)
+                    attachment.write({
+                        'batch': batch + 1,
+                        'batch_offset': reader.tell(),
+                        'batch_row': first_row + len(batched_rows),
+                        'import_batch_size': next_size,
+                    })
+                    stats = self.env['product.import.batch']._record(
+                        doc, timer,
+                        batch=batch,
+                        first_row=first_row + 2,
+                        batch_offset=reader.tell(),
+                        rows=len(batched_rows),
+                        created=len(new_product_templates),
+                        updated=len(updated_products['to_update_variants']),
+                        unchanged=len(unchanged),
+                    )
+                    with timer('commit'):
+                        self._cr.commit()
+                    stats._record_commit(timer)
+                    if next_size != batch_size:
+                        _logger.info(f'Batch size for {doc.attachment_name} changed from {batch_size} to {next_size}.')
+                        batch_size = next_size
+                except Exception as e:
+                    _logger.error(f"There was an error somewhere in file {doc.attachment_name} between rows {first_row + 2} and {first_row + batch_size + 1}.\nError: {e}")
+                    self._cr.rollback()
+                    return 'failed'
+        doc.invalidate_cache()
+        return 'done'
+
+    def _preview_documents(self, documents, batch_size=10000):
+        ''' Dry run of _import_documents: tell what importing the documents would do without writing any
+        product. Every document gets a csv attachment listing the products it would create and the fields
+        it would change on existing ones, and a message summing up the counts. '''
+        self = self.with_context(active_test=False, prefetch_fields=False)
+        company = self.company_id or self.env.company
+        # Product codes seen in the documents, to count the products that would become stale
+        self._cr.execute('DROP TABLE IF EXISTS wds_preview_codes')
+        self._cr.execute('CREATE TEMPORARY TABLE wds_preview_codes (code VARCHAR) ON COMMIT DROP')
+        for doc in documents:
+            counts = self._preview_document(doc, batch_size)
+            if counts is None:
+                continue
+            _logger.info(f'Import preview of {doc.attachment_name}: {counts}')
+        self._cr.execute('''
+            SELECT COUNT(*)
+            FROM product_template
+            WHERE
+                (active OR to_remove IS NOT TRUE)
+                AND NOT EXISTS (SELECT 1 FROM wds_preview_codes WHERE code = product_template.product_code)
+        ''')
+        stale = self._cr.fetchone()[0]
+        handling = dict(company._fields['stale_product_handling'].selection)[company.stale_product_handling]
+        summary = _('%s existing products are in none of the previewed documents (stale product handling: %s).') % (stale, handling)
+        for doc in documents:
+            doc.message_post(body=summary)
+        self._cr.execute('DROP TABLE wds_preview_codes')
+        return True
+
+    def _preview_document(self, doc, batch_size):
+        ''' Classify the rows of one document against existing products. Returns the counts of the preview. '''
+        attachment = doc.attachment_id
+        reader = attachment._get_spreadsheet_reader()
+        if reader is None:
+            return None
+        counts = dict.fromkeys(('rows', 'create', 'update', 'unchanged', 'variant_changes', 'price_changes', 'duplicates', 'invalid'), 0)
+        variant_fields = {f'{name}_{idx}' for name in ('size', 'unit', 'unitqty') for idx in range(1, 4)}
+        price_fields = {f'{name}_{idx}' for name in ('cost', 'list') for idx in range(1, 4)}
+        seen = set()
+        diff = FilestoreWriter(self.env['ir.attachment'])
+        diff.write(csv_record(['product_code', 'action', 'changes']))
+        try:
+            # A failing query only rolls back this document, the others and the stale count still run
+            with self._cr.savepoint(), reader:
+                column_plan = self._get_column_plan(tuple(reader.headers))
+                code_index = column_plan.fields.index('product_code')
+                first_row = 0
+                while True:
+                    rows = reader.read(batch_size)
+                    if not rows:
+                        break
+                    counts['rows'] += len(rows)
+                    cleaned_rows, errors = clean_data_batch(rows, column_plan, first_row)
+                    counts['invalid'] += len({row_number for row_number, *_error in errors})
+                    # The split keeps the last row of a code repeated in the batch, count the others first
+                    batch_codes = Counter(row[code_index] for row in cleaned_rows if row[code_index])
+                    counts['duplicates'] += sum(batch_codes.values()) - len(batch_codes)
+                    to_create, to_update, unchanged = self._split_cleaned_rows(cleaned_rows, column_plan)
+                    # Rows are classified before they can be matched with the ones of earlier batches
+                    codes = [row[code_index] for row in to_create.rows] + [row[code_index] for row in to_update.rows.values()]
+                    counts['unchanged'] += len(unchanged)
+                    buffer = io.StringIO()
+                    buffer.writelines(_copy_value(code) + '\n' for code in codes if code)
+                    buffer.seek(0)
+                    self._cr.copy_expert('COPY wds_preview_codes (code) FROM STDIN', buffer)
+                    self._cr.execute('''
+                        INSERT INTO wds_preview_codes (code)
+                        SELECT product_code FROM product_template WHERE id IN %s
+                    ''', (tuple(unchanged) or (0, ), ))
+                    for row in to_create.rows:
+                        code = row[code_index]
+                        if code and code in seen:
+                            counts['duplicates'] += 1
+                            continue
+                        seen.add(code)
+                        counts['create'] += 1
+                        diff.write(csv_record([code, 'create', '']))
+                    changes = self._preview_changes(to_update, column_plan.fields)
+                    for product_id, row in to_update.rows.items():
+                        code = row[code_index]
+                        if code in seen:
+                            counts['duplicates'] += 1
+                            continue
+                        seen.add(code)
+                        changed = changes[product_id]
+                        counts['update'] += 1
+                        counts['variant_changes'] += bool(variant_fields.intersection(changed))
+                        counts['price_changes'] += bool(price_fields.intersection(changed))
+                        diff.write(csv_record([code, 'update', '; '.join(
+                            f'{field}: {old!r} -> {new!r}' for field, (old, new) in changed.items()
+                        )]))
+                    first_row += len(rows)
+        except Exception as e:
+            diff.discard()
+            _logger.error(f'Could not preview the import of {doc.attachment_name}.\nError: {e}')
+            return None
+        diff_attachment = diff.save(f'{os.path.splitext(doc.attachment_name or "import")[0]}_preview.csv')
+        diff_attachment.write({'res_model': doc._name, 'res_id': doc.id})
+        doc.message_post(
+            body=_(
+                'Import preview: %(rows)s rows, %(create)s products to create, %(update)s to update '
+                '(%(variant_changes)s with variant changes, %(price_changes)s with price changes), '
+                '%(unchanged)s unchanged, %(duplicates)s duplicate and %(invalid)s invalid rows.'
+            ) % counts,
+            attachment_ids=diff_attachment.ids,
+        )
+        return counts
+
+    def _preview_changes(self, import_rows, fields):
+        ''' Map the ids of ImportRows to {field: (current value, imported value)} for the fields that would change. '''
+        if not import_rows.rows:
+            return {}
+        fields = [field for field in fields if field in self._fields and self._fields[field].store]
+        indices = [import_rows.fields.index(field) for field in fields]
+        self._cr.execute(
+            f"SELECT id, {', '.join(fields)} FROM product_template WHERE id IN %s",
+            (tuple(import_rows.rows), )
+        )
+        changes = {}
+        for product_id, *current in self._cr.fetchall():
+            row = import_rows.rows[product_id]
+            changes[product_id] = {
+                field: (old, row[index])
+                for field, index, old in zip(fields, indices, current)
+                if _value_changed(old, row[index])
+            }
+        return changes
+
+    def _create_shared_import_records(self, rows, fields):
+        ''' Create the size attribute values and vendors used by cleaned rows of `fields`, and commit them.
+
+        Parallel workers would otherwise insert the same product_attribute_value and res_partner rows
+        in their batch transactions and wait on (or deadlock with) each other until commit. This must run
+        before the batch's first query: cursors are REPEATABLE READ, so rows committed after the batch
+        took its snapshot stay invisible to it, and its inserts would conflict with them (or duplicate
+        vendors, which have no unique constraint) instead of finding them.
+
+        Workers take turns through a session advisory lock, and insert in a transaction started once
+        they hold it, so that they see the records created by the worker before them.
+        '''
+        position = {field: index for index, field in enumerate(fields)}
+        sizes = set()
+        vendors = set()
+        for idx in range(1, 4):
+            if f'unitqty_{idx}' in position and f'size_{idx}' in position:
+                unitqty, size = position[f'unitqty_{idx}'], position[f'size_{idx}']
+                sizes.update(row[size] for row in rows if row[unitqty] and row[size])
+        if 'vendor_name' in position:
+            vendors.update(row[position['vendor_name']] for row in rows if row[position['vendor_name']])
+        if not sizes and not vendors:
+            return
+        size_attr_id = self.env.ref('wds_product_importing.size_attribute').id
+        cr = self._cr
+        cr.commit()
+        cr.execute('SELECT pg_advisory_lock(%s)', (_SHARED_RECORDS_LOCK, ))
+        try:
+            cr.commit()
+            cr.execute(_queries['create_shared_product_attribute_values'], {'sizes': list(sizes), 'size_attr_id': size_attr_id})
+            cr.execute(_queries['create_shared_res_partner'], {'vendors': list(vendors)})
+            cr.commit()
+        except Exception:
+            cr.rollback()
+            raise
+        finally:
+            cr.execute('SELECT pg_advisory_unlock(%s)', (_SHARED_RECORDS_LOCK, ))
+            cr.commit()
+
+    def _update_website_search_text(self):
+        ''' Refresh the shop search columns of products written by the import, which bypasses the ORM. '''
+        self._cr.execute(_queries['write_website_search_text'], {'tmpl_ids': tuple(self.ids)})
+
+    def _handle_stale_products(self, generation):
+        ''' Revive products stamped with the current import generation and flag (or archive) older ones.
+
+        Only rows whose state actually changes are written, so this stays cheap when most of the catalog
+        was in the import.
+        '''
+        company = self.company_id or self.env.company
+        archive = company.stale_product_handling == 'archive'
         tables = ('product_template', 'product_product')
         for table in tables:
             self._cr.execute(f'''
                 UPDATE {table}
                 SET active = true, to_remove = false
-                WHERE attachment_id IN %s
-            ''', (tuple(documents.mapped('attachment_id').ids), ))
+                WHERE
+                    import_generation = %(generation)s
+                    AND (NOT active OR to_remove)
+            ''', {'generation': generation})
+            revived = self._cr.rowcount
 
             self._cr.execute(f'''
                 UPDATE {table}
                 SET 
-                    {"active = false," if company.stale_product_handling == 'archive' else ''} 
+                    {"active = false," if archive else ''} 
                     to_remove = true
                 WHERE
-                    attachment_id NOT IN %s OR attachment_id IS NULL
-            ''', (tuple(documents.mapped('attachment_id').ids), ))
+                    (import_generation < %(generation)s OR import_generation IS NULL)
+                    AND ({"active OR " if archive else ''}to_remove IS NOT TRUE)
+            ''', {'generation': generation})
+            _logger.info(f'{table}: {self._cr.rowcount} stale rows {"archived" if archive else "flagged"}, {revived} rows restored.')
+        self.env['product.template.attribute.value']._invalidate_active_variant_values()
 
         self._cr.commit()
 
@@ -236,53 +689,319 @@ class ProductTemplate(models.Model):
         dropship_route = self.env.ref('stock_dropshipping.route_drop_shipping')
         self.write({'route_ids': [(4,dropship_route.id,0)]})
 
-    def _import_images(self, batch_size = 80):
+    def _import_images(self, batch_size = 400):
         self = self.with_context(active_test=False, prefetch_fields=False, mail_notrack=True, tracking_disable=True, mail_activity_quick_update=False)
-        if self:
-            count = len(self)
-            batch_size = count
-        else:
-            domain = [('image_updated','=',True),('image_failed','=',False)]
-            count = self.search(domain,count=True)
-        num_batches = math.ceil(count / batch_size)
-        _logger.info(f"Started importing images. {count} images to import.")
-        for _ in range(num_batches):
-            try:
-                if threading.current_thread().timed_out:
-                    return False
-            except AttributeError:  # timed_out won't exist if launched from action menu and not cron
-                pass
-            images_to_update = self or self.search(domain, limit=batch_size) # No need to set an offset since we are committing at the end of each iteration
-            for product in images_to_update:
-                product._import_single_image()
-                # try:
-                #     product.image_1920 = product._import_image_cached(product.image_url, product.id)
-                #     product.image_updated = False
-                #     product.image_failed = False
-                # except Exception:
-                #     _logger.warning(f'Error importing image on product {product.name}')
-                #     product.image_1920 = self.env.company.logo
-                #     product.image_failed = True
-            images_to_update._cr.commit()
-            _logger.info(f"Batch of {len(images_to_update)} images imported.")
+        fetcher = self._get_image_fetcher()
+        resizer = self._get_image_resizer()
+        try:
+            if self:
+                # Products picked by hand are downloaded right away, bypassing the queue
+                _logger.info(f"Started importing images. {len(self)} images to import.")
+                for ids in tools.split_every(batch_size, self.ids):
+                    products = self.browse(ids)
+                    failed = self.browse(list(products._import_images_batch(fetcher, resizer)))
+                    if failed:
+                        failed._set_image_failed()
+                    products._cr.commit()
+                    _logger.info(f"Batch of {len(products)} images imported.")
+            else:
+                Job = self.env['product.image.job']
+                Job._enqueue_flagged()
+                Job._cr.commit()
+                while True:
+                    if _import_timed_out():
+                        return False
+                    jobs = Job._claim(batch_size)
+                    # Make the claim visible so that other workers skip these jobs
+                    Job._cr.commit()
+                    if not jobs:
+                        break
+                    products = jobs.product_tmpl_id.with_context(self.env.context)
+                    try:
+                        errors = products._import_images_batch(fetcher, resizer)
+                    except Exception as e:
+                        # Still close the claimed jobs, so they are retried and given up like failed downloads
+                        _logger.exception(f'Error importing images on products {products.ids}')
+                        Job._cr.rollback()
+                        self.env.clear()
+                        errors = dict.fromkeys(products.ids, str(e) or e.__class__.__name__)
+                    failed = products.browse(list(errors))
+                    # Retrying won't help products without an image url
+                    given_up = jobs._finish(errors, give_up=set(failed.filtered(lambda p: not p.image_url).ids))
+                    if given_up:
+                        given_up.with_context(self.env.context)._set_image_failed()
+                    Job._cr.commit()
+                    _logger.info(f"Batch of {len(jobs)} images imported, {len(failed)} failed, {len(given_up)} given up.")
+        finally:
+            fetcher.close()
+            resizer.close()
+        self._log_image_dedup_stats()
         _logger.info("Image import done.")
         return True
 
+    def _import_images_batch(self, fetcher, resizer=None):
+        ''' Download the images of all products concurrently, then write them in bulk on the current cursor.
+        Returns {product id: error message} for the products whose image could not be downloaded or stored.
+
+        Urls downloaded before are asked whether their image changed: when it didn't, the image stored
+        back then is reused without downloading or resizing it again. '''
+        ImageSource = self.env['product.image.source']
+        urls = {url for url in self.mapped('image_url') if url}
+        validators = ImageSource._get_validators(urls)
+        images = fetcher.fetch(urls, validators)
+        products_by_url = defaultdict(lambda: self.browse())
+        for product in self:
+            products_by_url[product.image_url] |= product
+        errors = {}
+        downloaded = []
+        checksums = {}
+        for url, products in products_by_url.items():
+            if url and images.get(url) is NOT_MODIFIED:
+                source = validators[url]
+                products._set_unmodified_image(source['checksum'], self.browse(source['product_id']))
+            elif url and images.get(url):
+                checksums[url] = hashlib.sha1(base64.b64decode(images[url])).hexdigest()
+                downloaded.append((products, images[url], checksums[url]))
+            else:
+                errors.update(dict.fromkeys(products.ids, fetcher.errors.get(url, 'No image url') if url else 'No image url'))
+        ImageSource._record(fetcher.responses, checksums)
+        errors.update(self._set_downloaded_images(downloaded, resizer))
+        if errors:
+            _logger.warning(f'Error importing images on products {list(errors)}')
+        return errors
+
+    @api.model
+    def _set_downloaded_images(self, downloaded, resizer=None):
+        ''' Set downloaded images, given as a list of (products, base64 image, checksum or None), deduplicated
+        by content.
+
+        Only one product per distinct image gets the image stored. Its smaller sizes are computed by
+        `resizer` (in the current process by default, with the configured sizes) for all new images at once and created as
+        attachments in one go, instead of being recomputed one by one by the ORM. The other products with
+        the same bytes, in this batch or imported earlier, get copies of that product's attachment rows:
+        they point to the same files in the filestore, so the image is neither resized nor stored again.
+
+        Each distinct image is stored in its own savepoint: an image that can't be resized or written only
+        fails its own products. Returns {product id: error message} for those products.
+        '''
+        by_checksum = defaultdict(lambda: [self.browse(), None])
+        for products, data, checksum in downloaded:
+            checksum = checksum or hashlib.sha1(base64.b64decode(data)).hexdigest()
+            by_checksum[checksum][0] |= products
+            by_checksum[checksum][1] = data
+        if not by_checksum:
+            return {}
+        all_products = self.browse().union(*(products for products, data in by_checksum.values()))
+        sources = self._get_image_sources(list(by_checksum), all_products.ids)
+        done = {'image_updated': False, 'image_failed': False}
+        errors = {}
+
+        # Store every new image on its first product, with all its sizes written in one step
+        new_checksums = [checksum for checksum in by_checksum if checksum not in sources]
+        resized_images = (resizer or self._get_image_resizer(workers=0)).resize([by_checksum[checksum][1] for checksum in new_checksums])
+        sized_fields = [f'image_{size}' for size in IMAGE_SIZES if size != 1920]
+        for checksum, (resized, error) in zip(new_checksums, resized_images):
+            products = by_checksum[checksum][0]
+            source = products[0]
+            try:
+                if error:
+                    raise ValueError(error)
+                with self._cr.savepoint():
+                    source._unlink_image_attachments(sized_fields)
+                    source.write(dict(done, image_1920=resized[1920], image_checksum=checksum))
+                    # The sizes were computed by the resizer, don't let the ORM compute them again
+                    for fname in sized_fields:
+                        self.env.remove_to_compute(self._fields[fname], source)
+                    self.env['ir.attachment'].sudo().create([{
+                        'name': f'image_{size}',
+                        'res_model': self._name,
+                        'res_field': f'image_{size}',
+                        'res_id': source.id,
+                        'type': 'binary',
+                        'datas': data,
+                    } for size, data in resized.items() if size != 1920 and data])
+                source.invalidate_cache(fnames=sized_fields)
+            except Exception as e:
+                _logger.warning(f'Error storing image on products {products.ids}: {e}')
+                errors.update(dict.fromkeys(products.ids, str(e) or e.__class__.__name__))
+                del by_checksum[checksum]
+                continue
+            by_checksum[checksum][0] -= source
+            sources[checksum] = source.id
+
+        for checksum, (products, data) in by_checksum.items():
+            if not products:
+                continue
+            try:
+                with self._cr.savepoint():
+                    products._copy_images_from(self.browse(sources[checksum]))
+                    products.write(dict(done, image_checksum=checksum))
+            except Exception as e:
+                _logger.warning(f'Error storing image on products {products.ids}: {e}')
+                errors.update(dict.fromkeys(products.ids, str(e) or e.__class__.__name__))
+        return errors
+
+    def _set_unmodified_image(self, checksum, source):
+        ''' Set the image of `source`, unchanged on the server, on these products. Products that already
+        show it are left as they are. '''
+        done = {'image_updated': False, 'image_failed': False}
+        up_to_date = self.filtered(lambda product: product.image_checksum == checksum)
+        outdated = self - up_to_date
+        if outdated:
+            outdated._copy_images_from(source)
+            outdated.write(dict(done, image_checksum=checksum))
+        if up_to_date:
+            up_to_date.write(done)
+
+    @api.model
+    def _get_image_sources(self, checksums, exclude_ids):
+        ''' Map image checksums to a product, outside of exclude_ids, that already has this image stored. '''
+        self.flush(['image_checksum'])
+        self._cr.execute('''
+            SELECT DISTINCT ON (product_template.image_checksum)
+                product_template.image_checksum, product_template.id
+            FROM
+                product_template
+                JOIN ir_attachment ON
+                    ir_attachment.res_model = 'product.template'
+                    AND ir_attachment.res_field = 'image_1920'
+                    AND ir_attachment.res_id = product_template.id
+            WHERE
+                product_template.image_checksum IN %s
+                AND product_template.id NOT IN %s
+            ORDER BY
+                product_template.image_checksum, product_template.id
+        ''', (tuple(checksums), tuple(exclude_ids) or (0, )))
+        return dict(self._cr.fetchall())
+
+    def _unlink_image_attachments(self, fnames):
+        ''' Delete the attachments storing the given image fields of these products. '''
+        Attachment = self.env['ir.attachment'].sudo()
+        Attachment.flush()
+        self._cr.execute('''
+            DELETE FROM ir_attachment
+            WHERE res_model = 'product.template' AND res_field IN %s AND res_id IN %s
+            RETURNING store_fname
+        ''', (tuple(fnames), tuple(self.ids)))
+        # Files still used by other attachments are kept by the filestore garbage collector
+        for store_fname, in self._cr.fetchall():
+            if store_fname:
+                Attachment._file_delete(store_fname)
+        self.invalidate_cache(fnames=list(fnames))
+        Attachment.invalidate_cache()
+
+    def _copy_images_from(self, source):
+        ''' Replace the image attachments of these products by copies of the ones of `source`. '''
+        image_fields = tuple(name for name, field in self._fields.items() if field.type == 'binary' and field.attachment and name.startswith('image_'))
+        Attachment = self.env['ir.attachment'].sudo()
+        self._unlink_image_attachments(image_fields)
+        Attachment.flush()
+        self._cr.execute('''
+            INSERT INTO ir_attachment
+                (name, res_model, res_field, res_id, company_id, type, url, public, access_token, store_fname,
+                 db_datas, file_size, checksum, mimetype, index_content, create_uid, create_date, write_uid, write_date)
+            SELECT
+                ir_attachment.name, res_model, res_field, product.id, company_id, type, url, public, access_token, store_fname,
+                db_datas, file_size, checksum, mimetype, index_content,
+                %(uid)s, NOW() AT TIME ZONE 'UTC', %(uid)s, NOW() AT TIME ZONE 'UTC'
+            FROM
+                ir_attachment, unnest(%(product_ids)s) AS product(id)
+            WHERE
+                res_model = 'product.template' AND res_field IN %(fields)s AND res_id = %(source_id)s
+        ''', {'uid': self.env.uid, 'product_ids': self.ids, 'fields': image_fields, 'source_id': source.id})
+        self.invalidate_cache(fnames=list(image_fields))
+        Attachment.invalidate_cache()
+
+    @api.model
+    def _log_image_dedup_stats(self):
+        self._cr.execute('SELECT COUNT(DISTINCT image_checksum), COUNT(image_checksum) FROM product_template')
+        unique, products = self._cr.fetchone()
+        _logger.info(f'{unique} unique images shared by {products} products.')
+
+    def _set_image_failed(self):
+        ''' Show the company logo on products whose image download was given up. '''
+        self.write({'image_1920': self.env.company.logo, 'image_checksum': False, 'image_failed': True})
+
+    def write(self, vals):
+        # An image set by other means than the import no longer matches its checksum
+        if 'image_1920' in vals and 'image_checksum' not in vals:
+            vals = dict(vals, image_checksum=False)
+        return super(ProductTemplate, self).write(vals)
+
+    def _import_cached_image_or_enqueue(self):
+        ''' Set the image from the image cache without any network access, or queue the product for a
+        high priority download when the cache doesn't have it. '''
+        self.ensure_one()
+        entry = self.image_url and self._get_image_cache().get(self.image_url)
+        # A cached image that can't be stored is downloaded again by the queue
+        if not entry or self._set_downloaded_images([(self, base64.b64encode(entry['data']), None)]):
+            self.env['product.image.job'].sudo()._enqueue(self.ids, priority=10)
+
     def _import_single_image(self):
         self.ensure_one()
         try:
-            self.image_1920 = self._import_image_cached(self.image_url, self.id)
-            self.image_updated = False
-            self.image_failed = False
+            errors = self._set_downloaded_images([(self, self._import_image_cached(self.image_url, self.id), None)])
         except Exception:
+            errors = True
+        if errors:
             _logger.warning(f'Error importing image on product {self.name}')
             self.image_1920 = self.env.company.logo
             self.image_failed = True
 
     @api.model
-    @tools.ormcache('url')
-    def _import_image_cached(self, url, line_number = 0):
-        return self.env['base_import.import']._import_image_by_url(url, requests.Session(), 'image_1920', line_number)
+    def _get_image_cache(self):
+        params = self.env['ir.config_parameter'].sudo()
+        return get_image_cache(
+            os.path.join(config.filestore(self._cr.dbname), 'wds_image_cache'),
+            int(params.get_param('wds_product_importing.image_cache_size', 1024)) * 1024 * 1024,
+            int(params.get_param('wds_product_importing.image_cache_max_age', 24)) * 3600,
+        )
+
+    @api.model
+    def _import_image_cached(self, url, line_number = 0, session=None):
+        return fetch_image(self._get_image_cache(), session or requests.Session(), url, **self._get_image_download_limits())
+
+    @api.model
+    def _get_image_download_limits(self):
+        return {
+            'timeout': int(config.get("import_image_timeout", DEFAULT_IMAGE_TIMEOUT)),
+            'maxsize': int(config.get("import_image_maxbytes", DEFAULT_IMAGE_MAXBYTES)),
+        }
+
+    @api.model
+    def _get_image_resizer(self, workers=None):
+        ''' Resizer for the image import. `image_resize_workers` processes resize images, 0 resizes them in
+        the cron worker; `workers` overrides it. Sizes missing from `image_sizes` are never generated. '''
+        if workers is None:
+            workers = self.env['ir.config_parameter'].sudo().get_param('wds_product_importing.image_resize_workers')
+            workers = int(workers) if workers else min(os.cpu_count() or 1, 4)
+        return ImageResizer(workers=workers, sizes=self._get_image_sizes())
+
+    @api.model
+    def _get_image_sizes(self):
+        ''' Image sizes generated by the import, from the `image_sizes` system parameter. '''
+        sizes = self.env['ir.config_parameter'].sudo().get_param('wds_product_importing.image_sizes', ','.join(map(str, IMAGE_SIZES)))
+        return [int(size) for size in sizes.split(',') if size.strip()]
+
+    @api.model
+    def _get_served_image_field(self, field):
+        ''' Image field to serve for `field`: sizes the import doesn't generate are served from the next
+        larger size it does. '''
+        size = field[len('image_'):]
+        if not field.startswith('image_') or not size.isdigit() or int(size) not in IMAGE_SIZES:
+            return field
+        stored = {1920} | {size for size in self._get_image_sizes() if size in IMAGE_SIZES}
+        return f'image_{min(stored_size for stored_size in stored if stored_size >= int(size))}'
+
+    @api.model
+    def _get_image_fetcher(self):
+        params = self.env['ir.config_parameter'].sudo()
+        return ImageFetcher(
+            self._get_image_cache(),
+            workers=int(params.get_param('wds_product_importing.image_fetch_workers', 16)),
+            per_host=int(params.get_param('wds_product_importing.image_fetch_per_host', 4)),
+            **self._get_image_download_limits()
+        )
 
     def _update_product_variants(self):
         params = {
@@ -290,7 +1009,8 @@ class ProductTemplate(models.Model):
             'size_attr_id': self.env.ref('wds_product_importing.size_attribute').id,
             'field_id': self.env['ir.model.fields'].search([('name','=','standard_price'),('model','=','product.product')], limit=1).id,
             'company_id': self.env.company.id,
-            'attachment_id': self.env.context.get('attachment_id', None)
+            'attachment_id': self.env.context.get('attachment_id', None),
+            'import_generation': self.env.context.get('import_generation', None),
         }
         # CREATE ANY NEW ATTRIBUTES
         self._cr.execute(_queries['create_product_attribute_values'], params)
@@ -301,41 +1021,108 @@ class ProductTemplate(models.Model):
         params['new_product_ids'] = tuple(product_ids)
         # UPDATE COMBINATION_INDICES ON PRODUCT_PRODUCT
         self._cr.execute(_queries['write_product_product_combination_indices'], params)
+        self.env['product.template.attribute.value']._invalidate_active_variant_values()
 
         return True
 
     def _get_fields_column_mapping(self, headers):
         ''' Creates a dict mapping fields to csv/xlsx headers '''
-        fields = self.fields_get()
-        field_strings = {v['string']: f for f, v in fields.items()}
-        field_strings_lower = {v['string'].lower(): f for f, v in fields.items()}
+        fields = self._fields
+        field_strings = {v.string: f for f, v in fields.items()}
+        field_strings_lower = {v.string.lower(): f for f, v in fields.items()}
         mapping = {}
         for header in headers:
             mapped_field = field_strings.get(header.strip(),False) or \
                             field_strings_lower.get(header.lower().strip(),False) or \
-                            fields.get(header.lower().strip(),{}).get('name',False) or \
+                            (header.lower().strip() in fields and header.lower().strip()) or \
                             False
             if mapped_field:
                 mapping[mapped_field] = {
                     'name': header,
-                    'type': fields[mapped_field]['type']
+                    'type': fields[mapped_field].type
                 }
         return mapping
 
-    def _split_rows_into_new_and_existing_products(self, rows, mapping):
-        ''' Parse a list of rows and splits them into existing and new products '''
+    @tools.ormcache('headers')
+    def _get_column_plan(self, headers):
+        ''' Compiled ColumnPlan for a header row. Cached on the registry, so split parts of the same file
+        and later imports with the same layout don't resolve their headers again. '''
+        mapping = self._get_fields_column_mapping(headers)
+        # Columns for fields the import sets itself would be written twice
+        reserved = {'import_hash'} | set(self._extra_import_create_vals()) | set(self._extra_import_update_vals())
+        return compile_column_plan({f: v for f, v in mapping.items() if f not in reserved}, headers)
+
+    def _split_rows_into_new_and_existing_products(self, rows, plan, first_row=0):
+        ''' Parse a list of rows and splits them into new products, existing products to update and the
+        ids of existing products whose content didn't change since they were last imported.
+
+        New and updated products are returned as ImportRows: tuples of the cleaned values followed by the
+        import fingerprint and the extra import values, sharing one tuple of field names.
+        Existing products are matched on product_code with a single query for the whole batch. If the
+        same product_code appears more than once in a batch, the last row wins.
+        '''
+        return self._split_cleaned_rows(self._clean_rows(rows, plan, first_row), plan)
+
+    @api.model
+    def _clean_rows(self, rows, plan, first_row=0):
+        ''' clean_data_batch, logging the rows skipped because of invalid cells. '''
+        cleaned_rows, errors = clean_data_batch(rows, plan, first_row)
+        for row_number, header, value, error in errors:
+            _logger.warning(f'Skipping row {row_number}: invalid value {value!r} in column {header}: {error}')
+        return cleaned_rows
+
+    def _split_cleaned_rows(self, cleaned_rows, plan):
+        ''' Split rows already cleaned by clean_data_batch, see _split_rows_into_new_and_existing_products. '''
+        code_index = plan.fields.index('product_code')
+        existing_products = self._get_products_by_code(row[code_index] for row in cleaned_rows)
+        update_vals = self._extra_import_update_vals()
+        create_vals = self._extra_import_create_vals()
+        update_tail = tuple(update_vals.values())
+        create_tail = tuple(create_vals.values())
+        hash_row = row_hasher(plan.fields)
         to_update = {}
-        to_create = []
-        for row in rows:
-            product = self.search([('product_code', '=', row.get(mapping['product_code']['name']))], limit=1)
-            data = clean_data_row(row, mapping)
-            if product:
-                data.update(product._extra_import_update_vals())
-                to_update[product.id] = data
+        to_create = {}
+        unchanged = {}
+        for idx, row in enumerate(cleaned_rows):
+            fingerprint = hash_row(row)
+            product_id, import_hash = existing_products.get(row[code_index], (None, None))
+            if product_id and import_hash == fingerprint:
+                to_update.pop(product_id, None)
+                unchanged[product_id] = True
+            elif product_id:
+                unchanged.pop(product_id, None)
+                to_update[product_id] = row + (fingerprint, ) + update_tail
             else:
-                data.update(self._extra_import_create_vals())
-                to_create.append(data)
-        return to_create, to_update
+                # Rows without a product code can't be matched, so they are never merged together
+                to_create[row[code_index] or idx] = row + (fingerprint, ) + create_tail
+        return (
+            ImportRows(plan.fields + ('import_hash', ) + tuple(create_vals), list(to_create.values())),
+            ImportRows(plan.fields + ('import_hash', ) + tuple(update_vals), to_update),
+            list(unchanged),
+        )
+
+    def _get_products_by_code(self, codes):
+        ''' Map product codes to the (id, import_hash) of their product.template. The lowest id wins if a
+        code is used on several templates. Archived or stale templates have no import_hash here, so
+        they are never skipped as unchanged and their variants are restored by the update. '''
+        codes = list({code for code in codes if code})
+        if not codes:
+            return {}
+        self._cr.execute(_queries['select_products_by_code'], {'codes': codes})
+        return {code: (product_id, import_hash) for code, product_id, import_hash in self._cr.fetchall()}
+
+    def _mark_unchanged_products(self):
+        ''' Stamp products skipped by the import so that they are not handled as stale, without
+        rewriting rows that already carry the current attachment. '''
+        if not self:
+            return
+        params = {
+            'tmpl_ids': tuple(self.ids),
+            'attachment_id': self.env.context.get('attachment_id', None),
+            'import_generation': self.env.context.get('import_generation', None),
+        }
+        self._cr.execute(_queries['write_unchanged_product_template'], params)
+        self._cr.execute(_queries['write_unchanged_product_product'], params)
 
     def _extra_import_create_vals(self):
         return {
@@ -347,6 +1134,7 @@ class ProductTemplate(models.Model):
             'uom_id': self.env.ref('uom.product_uom_unit').id,
             'uom_po_id': self.env.ref('uom.product_uom_unit').id,
             'attachment_id': self.env.context.get('attachment_id', None),
+            'import_generation': self.env.context.get('import_generation', None),
             'active': True,
             'is_published': True,
             'sale_ok': True,
@@ -358,13 +1146,16 @@ class ProductTemplate(models.Model):
     def _extra_import_update_vals(self):
         return {
             'attachment_id': self.env.context.get('attachment_id', None),
+            'import_generation': self.env.context.get('import_generation', None),
             'active': True,
             'is_published': True,
         }
 
-    def _optimized_update(self, vals_dict):
-        ''' Update values for records via SQL, returning records that need further postprocessing '''
+    def _optimized_update(self, import_rows):
+        ''' Update values for records via SQL, returning records that need further postprocessing.
+        `import_rows` are ImportRows with value tuples by record id. '''
         Product = self.env['product.template']
+        vals_dict = import_rows.rows
         if not vals_dict:
             return {
                 'to_update_variants': Product, 
@@ -373,46 +1164,43 @@ class ProductTemplate(models.Model):
                 'no_new_variants': Product
             }
         # Step 0: Preprocessing
-        fields = list(list(vals_dict.values())[0].keys())
+        fields = list(import_rows.fields)
         fields.append('id')
-        values = [
-            tuple(list(vals.values()) + [id])
+        values = (
+            vals + (id, )
             for id, vals in vals_dict.items()
-        ]
+        )
 
         # Step 1: Read fields that we need to know if they change for additional postprocessing
-        fields_to_check = fields.copy()
-        fields_to_check.remove('attachment_id')
+        fields_to_check = [f for f in fields if f not in ('id', 'attachment_id', 'import_hash', 'import_generation')]
+        check_indices = [fields.index(f) for f in fields_to_check]
         product_ids = tuple(vals_dict.keys())
-        init_search_query = f"SELECT {', '.join(['id']+fields_to_check)} FROM product_template WHERE id IN %s ORDER BY id"
+        init_search_query = f"SELECT {', '.join(['id']+fields_to_check)} FROM product_template WHERE id IN %s"
         self._cr.execute(init_search_query, (product_ids, ))
-        init_values = self._cr.fetchall()
+        init_values = {row[0]: row[1:] for row in self._cr.fetchall()}
 
         # Step 2: Update
+        self._copy_into_staging_table(fields, values)
         set_params = ', '.join([f'{f} = payload.{f}' for f in fields])
         bulk_update_query = f'''
             UPDATE product_template
             SET {set_params}
-            FROM (VALUES %s) AS payload ({', '.join(fields)}) 
+            FROM wds_import_staging AS payload
             WHERE product_template.id = payload.id
         '''
-        execute_values(self._cr, bulk_update_query, values)
+        self._cr.execute(bulk_update_query)
 
-        # Step 3: Read those same fields
-        self._cr.execute(init_search_query, (product_ids, ))
-        final_values = self._cr.fetchall()
-
-        # Step 4: For all fields we care about that changed, determine which ones need additional computation
-        image_index = fields_to_check.index('image_url')+1
-        update_images = [
-            i[1][0] for i in zip(init_values, final_values)
-            if i[0][image_index] != i[1][image_index] and i[1][image_index]
-        ]
-        # size_indexes = range(1, 4)
-        update_variants = [
-            i[1][0] for i in zip(init_values, final_values)
-            if i[0] != i[1]
-        ]
+        # Step 3: For all fields we care about that changed, determine which ones need additional computation
+        image_index = fields_to_check.index('image_url')
+        update_images = []
+        update_variants = []
+        for id, vals in vals_dict.items():
+            old_values = init_values[id]
+            new_values = [vals[index] for index in check_indices]
+            if new_values[image_index] and _value_changed(old_values[image_index], new_values[image_index]):
+                update_images.append(id)
+            if any(_value_changed(old, new) for old, new in zip(old_values, new_values)):
+                update_variants.append(id)
         return {
             'to_update_variants': Product.browse(update_variants),
             'to_update_images': Product.browse(update_images),
@@ -420,26 +1208,31 @@ class ProductTemplate(models.Model):
             'no_new_variants': Product.browse(product_ids) - Product.browse(update_variants)
         }
 
-    def _optimized_create(self, vals_list):
-        ''' Create product.template via SQL '''
+    def _optimized_create(self, import_rows):
+        ''' Create product.template via SQL from ImportRows with a list of value tuples '''
         Product = self.env['product.template']
-        if not vals_list:
+        if not import_rows.rows:
             return Product
-        fields = list(vals_list[0].keys())
-        for idx, val in enumerate(vals_list):
-            vals_list[idx] = [v for k, v in val.items()]
-        query_create_templates = f"INSERT INTO product_template ( {', '.join(fields)} ) VALUES %s RETURNING id"
-        # fetch was added in psycopg version 2.8. If it doesn't exist we expand the page size adn then manually fetch
-        try:
-            tmpl_ids = execute_values(
-                self._cr, query_create_templates, vals_list, fetch=True)
-        except Exception:
-            execute_values(self._cr, query_create_templates,
-                           vals_list, page_size=len(vals_list))
-            tmpl_ids = self._cr.fetchall()
-        ids = [v[0] for v in tmpl_ids]
+        fields = import_rows.fields
+        self._copy_into_staging_table(fields, import_rows.rows)
+        self._cr.execute(f"INSERT INTO product_template ( {', '.join(fields)} ) SELECT {', '.join(fields)} FROM wds_import_staging RETURNING id")
+        ids = [v[0] for v in self._cr.fetchall()]
         return Product.browse(ids)
 
+    def _copy_into_staging_table(self, fields, rows):
+        ''' Load rows into the wds_import_staging table with COPY FROM STDIN, so that they can be applied
+        to product_template with set-based statements instead of one big VALUES string.
+
+        The staging table is a temporary table: it is unlogged, private to the current connection and
+        dropped when the batch is committed. Its columns take the types of the product_template columns.
+        '''
+        self._cr.execute('DROP TABLE IF EXISTS wds_import_staging')
+        self._cr.execute(f"CREATE TEMPORARY TABLE wds_import_staging ON COMMIT DROP AS SELECT {', '.join(fields)} FROM product_template WITH NO DATA")
+        buffer = io.StringIO()
+        buffer.writelines('\t'.join(map(_copy_value, row)) + '\n' for row in rows)
+        buffer.seek(0)
+        self._cr.copy_expert(f"COPY wds_import_staging ({', '.join(fields)}) FROM STDIN", buffer)
+
     def _set_list_price(self):
         params = {'tmpl_ids': tuple(self.ids)}
         self._cr.execute(_queries['write_product_product_lst_price'], params)
@@ -448,17 +1241,13 @@ class ProductTemplate(models.Model):
     def _update_pricelists(self):
         ''' Create vendor pricelists for each of the products imported. '''
         params = {
-            'field_id': self.env['ir.model.fields'].search([('name','=','standard_price'),('model','=','product.product')], limit=1).id,
             'tmpl_ids': tuple(self.ids),
             'currency_id': self.env.ref('base.main_company').currency_id.id,
             'company_id': self.env.company.id
         }
         # GENERATE ANY NEW PARTNERS
         self._cr.execute(_queries['create_res_partner'], params)
-        # DELETE ALL CURRENT PRICELISTS
-        self._cr.execute(_queries['unlink_product_supplierinfo'], params)
-        # CREATE NEW PRICELISTS
-        # 1) First, handle product templates with only a single variant
-        self._cr.execute(_queries['create_product_supplierinfo_single_variant'], params)
-        # 2) Handle products with multiple variants
-        self._cr.execute(_queries['create_product_supplierinfo_multiple_variant'], params)
+        # SYNC PRICELISTS: single variant templates get one per template, others one per variant
+        self._cr.execute(_queries['sync_product_supplierinfo'], params)
+        inserted, updated, deleted = self._cr.fetchone()
+        _logger.info(f'Vendor pricelists: {inserted} created, {updated} updated, {deleted} deleted.')
@@ -25,3 +25,25 @@ class ResCompany(models.Model):
         * Automatically archive: Archive all products and variants not existing in most recent import.
         * Flag for removal: Set the "To Remove" field to True for manual archival/deletion.
         * Don't do anything.: Self-explanatory.''')
+
+    image_fetch_mode = fields.Selection(string="Website Image Download", selection=[('queue','Queue in background'),('inline','Download while rendering')],
+        default='queue',
+        required=True,
+        help='''How to handle product images that still need downloading when the website asks for them:
+        * Queue in background: Serve the cached image or a placeholder right away and download the image with priority in the background.
+        * Download while rendering: Download the image before answering the request.''')
+
+    split_part_rows = fields.Integer(string="Split Part Rows", default=100000, required=True,
+                                     help="Maximum number of rows in each part when splitting a product document.")
+
+    split_part_size = fields.Integer(string="Split Part Size (MB)", default=0,
+                                     help="Maximum size of each part when splitting a product document. 0 means no limit.")
+
+    import_batch_seconds = fields.Integer(string="Import Batch Duration (s)", default=30, required=True,
+                                          help="Target duration of an import batch. Batch sizes grow or shrink after every batch to get close to it.")
+
+    import_workers = fields.Integer(string="Import Workers", default=1, required=True,
+                                    help="Number of documents imported at the same time, each with its own database connection.")
+
+    import_generation = fields.Integer(string="Import Generation", default=0, readonly=True,
+                                       help="Generation of the last complete import. Products not stamped with it are stale.")
@@ -13,4 +13,19 @@ class ResConfigSettings(models.TransientModel):
     complete_import_folder = fields.Many2one('documents.folder', related='company_id.complete_import_folder', readonly=False,
                                              string="product imported workspace")
 
-    stale_product_handling = fields.Selection(related='company_id.stale_product_handling', readonly=False)
\ No newline at end of file
+    stale_product_handling = fields.Selection(related='company_id.stale_product_handling', readonly=False)
+
+    image_fetch_mode = fields.Selection(related='company_id.image_fetch_mode', readonly=False)
+
+    split_part_rows = fields.Integer(related='company_id.split_part_rows', readonly=False)
+
+    split_part_size = fields.Integer(related='company_id.split_part_size', readonly=False)
+
+    import_workers = fields.Integer(related='company_id.import_workers', readonly=False)
+    import_batch_seconds = fields.Integer(related='company_id.import_batch_seconds', readonly=False)
+
+    image_cache_size = fields.Integer(string="Image Cache Size (MB)", default=1024,
+                                      config_parameter='wds_product_importing.image_cache_size')
+
+    image_cache_max_age = fields.Integer(string="Image Cache Revalidation (hours)", default=24,
+                                         config_parameter='wds_product_importing.image_cache_max_age')
\ No newline at end of file
@@ -112,16 +112,18 @@ _create_product_variant_combination = """
 
 _create_product_product = """
     INSERT INTO
-        product_product (product_tmpl_id, base_list_price, unit, unitqty, size, attachment_id, active, default_code)
+        product_product (product_tmpl_id, base_list_price, base_cost, unit, unitqty, size, attachment_id, import_generation, active, default_code)
     SELECT DISTINCT ON(default_code) 
-        tmpl_id, list, unit, unitqty, size, %(attachment_id)s, TRUE, line_values.default_code
+        tmpl_id, list, cost, unit, unitqty, size, %(attachment_id)s, %(import_generation)s, TRUE, line_values.default_code
     FROM
         line_values 
     ON CONFLICT ON CONSTRAINT product_product_default_code_unique 
     DO UPDATE SET
         base_list_price = EXCLUDED.base_list_price,
+        base_cost = EXCLUDED.base_cost,
         size = EXCLUDED.size,
         attachment_id = EXCLUDED.attachment_id,
+        import_generation = EXCLUDED.import_generation,
         active = TRUE 
     RETURNING id,
         product_tmpl_id,
@@ -212,7 +214,8 @@ _write_product_product_combination_indices = '''
     UPDATE product_product
     SET 
         combination_indices = combination_to_write.combination_indices,
-        attachment_id = %(attachment_id)s
+        attachment_id = %(attachment_id)s,
+        import_generation = %(import_generation)s
     FROM 
         (
             SELECT
@@ -286,13 +289,6 @@ _create_res_partner = '''
         vendor_name <> '' AND partner_id IS NULL
 '''
 
-_unlink_product_supplierinfo = '''
-    DELETE FROM product_supplierinfo
-    WHERE 
-        product_tmpl_id IN %(tmpl_ids)s 
-        OR product_id IN (SELECT id FROM product_product WHERE product_tmpl_id IN %(tmpl_ids)s)
-'''
-
 _select_product_variant_counts = '''
     SELECT
         product_product.product_tmpl_id,
@@ -306,51 +302,243 @@ _select_product_variant_counts = '''
     GROUP BY product_product.product_tmpl_id, res_partner.name
 '''
 
-_create_product_supplierinfo_single_variant = f'''
-    INSERT INTO product_supplierinfo
-        (sequence, name, product_tmpl_id, product_name, product_code, currency_id, mfr_name, mfr_num, company_id, min_qty, price, delay)
-    SELECT DISTINCT
-        1 as sequence,
-        product_variant_counts.vendor_id as name, 
+# Vendor pricelists the imported templates should have: one per template when it has a single variant,
+# one per variant otherwise
+_select_product_supplierinfo_single_variant = f'''
+    SELECT
+        product_variant_counts.vendor_id as name,
         product_template.id as product_tmpl_id,
-        NULL as product_name,
+        NULL::integer as product_id,
         product_template.default_code as product_code,
-        %(currency_id)s as currency_id,
         product_template.mfr_name as mfr_name,
         product_template.mfr_num as mfr_num,
-        %(company_id)s as company_id,
-        0 as min_qty,
-        product_template.cost_1 as price,
-        1 as delay
+        product_template.cost_1 as price
     FROM
         ({_select_product_variant_counts}) AS product_variant_counts
         JOIN product_template ON product_tmpl_id = product_template.id
     WHERE num_variants = 1
 '''
 
-_create_product_supplierinfo_multiple_variant = f'''
-    INSERT INTO product_supplierinfo
-        (sequence, name, product_tmpl_id, product_id, product_name, product_code, currency_id, mfr_name, mfr_num, company_id, min_qty, price, delay)
-    SELECT DISTINCT
-        1 as sequence,
-        product_variant_counts.vendor_id as name, 
+_select_product_supplierinfo_multiple_variant = f'''
+    SELECT
+        product_variant_counts.vendor_id as name,
         product_template.id as product_tmpl_id,
         product_product.id as product_id,
-        NULL as product_name,
         product_template.default_code as product_code,
-        %(currency_id)s as currency_id,
         product_template.mfr_name as mfr_name,
         product_template.mfr_num as mfr_num,
-        %(company_id)s as company_id,
-        0 as min_qty,
-        ir_property.value_float as price,
-        1 as delay
+        product_product.base_cost as price
     FROM
         ({_select_product_variant_counts}) AS product_variant_counts
         JOIN product_product ON product_variant_counts.product_tmpl_id = product_product.product_tmpl_id
         LEFT JOIN product_template ON product_product.product_tmpl_id = product_template.id
-        JOIN ir_property ON res_id = CONCAT('product.product,',product_product.id)
-    WHERE num_variants > 1 AND ir_property.fields_id = %(field_id)s
+    WHERE num_variants > 1
+'''
+
+# Sync vendor pricelists keyed on (vendor, template, variant): only rows whose price or manufacturer
+# changed are updated, only missing rows are inserted and only rows no longer in the import are deleted
+_sync_product_supplierinfo = f'''
+    WITH target AS (
+        SELECT DISTINCT ON (name, product_tmpl_id, product_id) *
+        FROM (
+            {_select_product_supplierinfo_single_variant}
+            UNION ALL
+            {_select_product_supplierinfo_multiple_variant}
+        ) AS supplierinfo
+        ORDER BY name, product_tmpl_id, product_id
+    ),
+    current AS (
+        SELECT *
+        FROM product_supplierinfo
+        WHERE
+            product_tmpl_id IN %(tmpl_ids)s
+            OR product_id IN (SELECT id FROM product_product WHERE product_tmpl_id IN %(tmpl_ids)s)
+    ),
+    deleted AS (
+        DELETE FROM product_supplierinfo
+        USING current
+        WHERE
+            product_supplierinfo.id = current.id
+            AND NOT EXISTS (
+                SELECT 1 FROM target
+                WHERE
+                    target.name = current.name
+                    AND target.product_tmpl_id = current.product_tmpl_id
+                    AND target.product_id IS NOT DISTINCT FROM current.product_id
+            )
+        RETURNING product_supplierinfo.id
+    ),
+    updated AS (
+        UPDATE product_supplierinfo
+        SET
+            price = target.price,
+            product_code = target.product_code,
+            mfr_name = target.mfr_name,
+            mfr_num = target.mfr_num
+        FROM
+            current
+            JOIN target ON
+                target.name = current.name
+                AND target.product_tmpl_id = current.product_tmpl_id
+                AND target.product_id IS NOT DISTINCT FROM current.product_id
+        WHERE
+            product_supplierinfo.id = current.id
+            AND (
+                current.price IS DISTINCT FROM target.price
+                OR current.product_code IS DISTINCT FROM target.product_code
+                OR current.mfr_name IS DISTINCT FROM target.mfr_name
+                OR current.mfr_num IS DISTINCT FROM target.mfr_num
+            )
+        RETURNING product_supplierinfo.id
+    ),
+    inserted AS (
+        INSERT INTO product_supplierinfo
+            (sequence, name, product_tmpl_id, product_id, product_name, product_code, currency_id, mfr_name, mfr_num, company_id, min_qty, price, delay)
+        SELECT
+            1 as sequence,
+            target.name,
+            target.product_tmpl_id,
+            target.product_id,
+            NULL as product_name,
+            target.product_code,
+            %(currency_id)s as currency_id,
+            target.mfr_name,
+            target.mfr_num,
+            %(company_id)s as company_id,
+            0 as min_qty,
+            target.price,
+            1 as delay
+        FROM
+            target
+        WHERE NOT EXISTS (
+            SELECT 1 FROM current
+            WHERE
+                target.name = current.name
+                AND target.product_tmpl_id = current.product_tmpl_id
+                AND target.product_id IS NOT DISTINCT FROM current.product_id
+        )
+        RETURNING id
+    )
+    SELECT
+        (SELECT COUNT(*) FROM inserted),
+        (SELECT COUNT(*) FROM updated),
+        (SELECT COUNT(*) FROM deleted)
+'''
+
+_select_products_by_code = '''
+    SELECT DISTINCT ON (product_code)
+        product_code,
+        id,
+        -- Archived or flagged products go through the update so their variants are restored too
+        CASE WHEN active AND to_remove IS NOT TRUE THEN import_hash END
+    FROM
+        product_template
+    WHERE
+        product_code = ANY(%(codes)s)
+    ORDER BY
+        product_code, id
+'''
+
+_write_unchanged_product_template = '''
+    UPDATE
+        product_template
+    SET
+        attachment_id = %(attachment_id)s,
+        import_generation = %(import_generation)s,
+        active = TRUE,
+        is_published = TRUE
+    WHERE
+        id IN %(tmpl_ids)s
+        AND (
+            attachment_id IS DISTINCT FROM %(attachment_id)s
+            OR import_generation IS DISTINCT FROM %(import_generation)s
+            OR NOT active
+            OR NOT is_published
+        )
+'''
+
+_write_unchanged_product_product = '''
+    UPDATE
+        product_product
+    SET
+        attachment_id = %(attachment_id)s,
+        import_generation = %(import_generation)s
+    WHERE
+        product_tmpl_id IN %(tmpl_ids)s
+        AND active
+        AND (
+            attachment_id IS DISTINCT FROM %(attachment_id)s
+            OR import_generation IS DISTINCT FROM %(import_generation)s
+        )
+'''
+
+_create_shared_product_attribute_values = '''
+    INSERT INTO product_attribute_value (name, attribute_id)
+    SELECT DISTINCT size, %(size_attr_id)s
+    FROM unnest(%(sizes)s) AS size
+    ON CONFLICT DO NOTHING
+'''
+
+_create_shared_res_partner = '''
+    INSERT INTO res_partner
+        (name, type, display_name, active)
+    SELECT
+        vendor_name, 'contact', vendor_name, TRUE
+    FROM
+        unnest(%(vendors)s) AS vendor_name
+    WHERE
+        vendor_name <> ''
+        AND NOT EXISTS (SELECT 1 FROM res_partner WHERE res_partner.name = vendor_name)
+'''
+
+# Same as ProductTemplate._compute_website_search_text, only rewriting rows whose text changed
+_write_website_search_text = '''
+    UPDATE
+        product_template
+    SET
+        website_search_text = search.text,
+        website_search_name = search.name_text
+    FROM
+        (
+            SELECT
+                product_template.id,
+                NULLIF(CONCAT_WS(' ',
+                    NULLIF(product_template.name, ''), NULLIF(product_code, ''), NULLIF(mfr_num, ''), NULLIF(mfr_name, ''),
+                    NULLIF(product_template.description, ''), NULLIF(description_sale, ''), translation.all_values
+                ), '') AS text,
+                NULLIF(CONCAT_WS(' ',
+                    NULLIF(product_template.name, ''), NULLIF(product_code, ''), NULLIF(mfr_num, ''), NULLIF(mfr_name, ''),
+                    translation.name_values
+                ), '') AS name_text
+            FROM
+                product_template
+                LEFT JOIN LATERAL (
+                    SELECT
+                        string_agg(ir_translation.value, ' ' ORDER BY ir_translation.name COLLATE "C", ir_translation.lang COLLATE "C") AS all_values,
+                        string_agg(ir_translation.value, ' ' ORDER BY ir_translation.lang COLLATE "C") FILTER (WHERE ir_translation.name = 'product.template,name') AS name_values
+                    FROM
+                        ir_translation
+                    WHERE
+                        ir_translation.type = 'model'
+                        AND ir_translation.name IN ('product.template,name', 'product.template,description', 'product.template,description_sale')
+                        AND ir_translation.res_id = product_template.id
+                        AND ir_translation.lang IN (SELECT code FROM res_lang WHERE active AND code <> 'en_US')
+                        AND ir_translation.value <> ''
+                        AND ir_translation.value IS DISTINCT FROM CASE ir_translation.name
+                            WHEN 'product.template,name' THEN product_template.name
+                            WHEN 'product.template,description' THEN product_template.description
+                            ELSE product_template.description_sale
+                        END
+                ) AS translation ON TRUE
+            WHERE
+                product_template.id IN %(tmpl_ids)s
+        ) AS search
+    WHERE
+        product_template.id = search.id
+        AND (
+            product_template.website_search_text IS DISTINCT FROM search.text
+            OR product_template.website_search_name IS DISTINCT FROM search.name_text
+        )
 '''
 
 _queries = {
@@ -360,7 +548,11 @@ _queries = {
     'write_product_product_lst_price': _write_product_product_lst_price,
     'write_product_template_list_price': _write_product_template_list_price,
     'create_res_partner': _create_res_partner,
-    'unlink_product_supplierinfo': _unlink_product_supplierinfo,
-    'create_product_supplierinfo_single_variant': _create_product_supplierinfo_single_variant,
-    'create_product_supplierinfo_multiple_variant': _create_product_supplierinfo_multiple_variant
+    'sync_product_supplierinfo': _sync_product_supplierinfo,
+    'select_products_by_code': _select_products_by_code,
+    'write_unchanged_product_template': _write_unchanged_product_template,
+    'write_unchanged_product_product': _write_unchanged_product_product,
+    'create_shared_product_attribute_values': _create_shared_product_attribute_values,
+    'create_shared_res_partner': _create_shared_res_partner,
+    'write_website_search_text': _write_website_search_text
 }
\ No newline at end of file
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import posixpath
+import re
+import zipfile
+from xml.etree.ElementTree import iterparse
+
+_REL_NS = '{http://schemas.openxmlformats.org/officeDocument/2006/relationships}'
+_CELL_REF = re.compile(r'([A-Z]+)(\d*)')
+
+
+def _local(tag):
+    return tag.rsplit('}', 1)[-1]
+
+
+def _column_index(ref):
+    ''' 'C7' -> 2 '''
+    index = 0
+    for char in _CELL_REF.match(ref).group(1):
+        index = index * 26 + ord(char) - 64
+    return index - 1
+
+
+def _first_sheet_path(archive):
+    ''' Find the xml of the first sheet of the workbook through its relationships. '''
+    try:
+        with archive.open('xl/workbook.xml') as workbook:
+            sheet_rid = next(
+                elem.get(_REL_NS + 'id') for _event, elem in iterparse(workbook) if _local(elem.tag) == 'sheet'
+            )
+        with archive.open('xl/_rels/workbook.xml.rels') as rels:
+            target = next(
+                elem.get('Target') for _event, elem in iterparse(rels)
+                if _local(elem.tag) == 'Relationship' and elem.get('Id') == sheet_rid
+            )
+    except (KeyError, StopIteration):
+        return 'xl/worksheets/sheet1.xml'
+    if target.startswith('/'):
+        return target.lstrip('/')
+    return posixpath.normpath(posixpath.join('xl', target))
+
+
+def _text(elem):
+    ''' Text of a shared or inline string: its own <t> or the <t> of its rich text runs, without phonetic runs. '''
+    parts = []
+    for child in elem:
+        tag = _local(child.tag)
+        if tag == 't':
+            parts.append(child.text or '')
+        elif tag == 'r':
+            parts.extend(t.text or '' for t in child if _local(t.tag) == 't')
+    return ''.join(parts)
+
+
+def _read_shared_strings(archive):
+    try:
+        strings = archive.open('xl/sharedStrings.xml')
+    except KeyError:
+        return []
+    shared_strings = []
+    with strings:
+        for _event, elem in iterparse(strings):
+            if _local(elem.tag) == 'si':
+                shared_strings.append(_text(elem))
+                elem.clear()
+    return shared_strings
+
+
+def _cell_value(cell, tags, shared_strings):
+    ''' Convert a cell to the value xlrd's row_values would give: floats for numbers and dates, ints for booleans. '''
+    cell_type = cell.get('t', 'n')
+    if cell_type == 'inlineStr':
+        inline = cell.find(tags['is'])
+        return _text(inline) if inline is not None else ''
+    value = cell.findtext(tags['v'])
+    if value is None:
+        return ''
+    if cell_type == 'n':
+        return float(value)
+    if cell_type == 's':
+        return shared_strings[int(value)]
+    if cell_type == 'b':
+        return int(value)
+    return value
+
+
+def iter_xlsx_rows(fileobj, skip_before=0):
+    ''' Parse the first sheet of an xlsx file incrementally, yielding (row index, values) tuples.
+
+    Only the shared strings table is kept in memory: every row is discarded once yielded, so memory
+    doesn't grow with the number of rows. Rows are padded with '' to the width of the sheet and empty
+    rows are yielded too, like xlrd does. The header row (index 0) is always yielded, rows between it
+    and `skip_before` are skipped without decoding their cells.
+    '''
+    with zipfile.ZipFile(fileobj) as archive:
+        shared_strings = _read_shared_strings(archive)
+        with archive.open(_first_sheet_path(archive)) as sheet:
+            events = iterparse(sheet, events=('start', 'end'))
+            _event, root = next(events)
+            namespace = root.tag[:root.tag.index('}') + 1] if root.tag.startswith('{') else ''
+            tags = {tag: namespace + tag for tag in ('sheetData', 'dimension', 'row', 'c', 'v', 'is')}
+            columns = {}
+            width = 0
+            next_index = 0
+            elem = root
+            for event, elem in events:
+                if event == 'start':
+                    if elem.tag == tags['sheetData']:
+                        break
+                elif elem.tag == tags['dimension'] and ':' in elem.get('ref', ''):
+                    width = _column_index(elem.get('ref').split(':')[1]) + 1
+            # From here on, only look at the end of rows and drop them from the tree once read
+            sheet_data = elem
+            for event, elem in events:
+                if event != 'end' or elem.tag != tags['row']:
+                    continue
+                index = int(elem.get('r')) - 1 if elem.get('r') else next_index
+                if index == 0 or index >= skip_before:
+                    # Rows missing from the xml are empty rows
+                    for empty_index in range(max(next_index, skip_before if index else 0), index):
+                        yield empty_index, [''] * width
+                    values = []
+                    for cell in elem:
+                        if cell.tag != tags['c']:
+                            continue
+                        ref = cell.get('r')
+                        if ref:
+                            letters = ref.rstrip('0123456789')
+                            column = columns.get(letters)
+                            if column is None:
+                                column = columns[letters] = _column_index(letters)
+                            if column > len(values):
+                                values.extend([''] * (column - len(values)))
+                        values.append(_cell_value(cell, tags, shared_strings))
+                    if index == 0:
+                        width = max(width, len(values))
+                    if len(values) < width:
+                        values.extend([''] * (width - len(values)))
+                    yield index, values
+                next_index = index + 1
+                sheet_data.clear()
@@ -0,0 +1,7 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+from . import test_image_fetcher
+from . import test_parallel_import
+from . import test_image_resizer
+from . import test_import_rows
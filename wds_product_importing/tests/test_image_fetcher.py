@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import base64
+import io
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import requests
+from PIL import Image
+
+from odoo.tests.common import BaseCase, tagged
+
+from ..models.image_cache import ImageCache
+from ..models.image_fetcher import NOT_MODIFIED, ImageFetcher, fetch_image_response
+
+ETAG = '"v1"'
+LAST_MODIFIED = 'Wed, 21 Oct 2015 07:28:00 GMT'
+
+
+def _make_image():
+    data = io.BytesIO()
+    Image.new('RGB', (4, 4), 'red').save(data, 'PNG')
+    return data.getvalue()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    ''' Serves one image with an ETag and a Last-Modified date, answering 304 when the request's
+    If-None-Match matches the ETag. Every request's headers are kept on the server. '''
+
+    def do_GET(self):
+        self.server.requests.append(dict(self.headers))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        self.send_header('Content-Length', str(len(self.server.image)))
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.end_headers()
+        self.wfile.write(self.server.image)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@tagged('post_install', '-at_install')
+class TestImageFetcher(BaseCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server = HTTPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.image = _make_image()
+        self.server.requests = []
+        thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f'http://127.0.0.1:{self.server.server_port}/image.png'
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        # An empty cache, so that every fetch asks the server
+        self.cache = ImageCache(cache_dir.name, 10 * 1024 * 1024, 0)
+
+    def test_fetch_new_image_records_validators(self):
+        response = fetch_image_response(self.cache, requests.Session(), self.url)
+        self.assertEqual(base64.b64decode(response['data']), self.server.image)
+        self.assertEqual(response['etag'], ETAG)
+        self.assertEqual(response['last_modified'], LAST_MODIFIED)
+        self.assertEqual(response['content_length'], len(self.server.image))
+        self.assertNotIn('If-None-Match', self.server.requests[0])
+
+    def test_fetch_not_modified(self):
+        validators = {'etag': ETAG, 'last_modified': LAST_MODIFIED}
+        response = fetch_image_response(self.cache, requests.Session(), self.url, validators=validators)
+        self.assertIs(response['data'], NOT_MODIFIED)
+        self.assertEqual(self.server.requests[0]['If-None-Match'], ETAG)
+        self.assertEqual(self.server.requests[0]['If-Modified-Since'], LAST_MODIFIED)
+
+    def test_fetcher_conditional_requests(self):
+        fetcher = ImageFetcher(self.cache, workers=2, per_host=1)
+        self.addCleanup(fetcher.close)
+
+        # The image stored for this url is up to date: nothing is downloaded
+        images = fetcher.fetch([self.url], {self.url: {'etag': ETAG, 'last_modified': LAST_MODIFIED}})
+        self.assertIs(images[self.url], NOT_MODIFIED)
+        self.assertEqual(fetcher.responses, {})
+        self.assertEqual(self.server.requests[-1]['If-None-Match'], ETAG)
+        self.assertEqual(self.server.requests[-1]['If-Modified-Since'], LAST_MODIFIED)
+
+        # The image changed on the server: it is downloaded with its new validators
+        images = fetcher.fetch([self.url], {self.url: {'etag': '"v0"', 'last_modified': None}})
+        self.assertEqual(base64.b64decode(images[self.url]), self.server.image)
+        self.assertEqual(self.server.requests[-1]['If-None-Match'], '"v0"')
+        self.assertNotIn('If-Modified-Since', self.server.requests[-1])
+        self.assertEqual(fetcher.responses[self.url]['etag'], ETAG)
+        self.assertEqual(fetcher.responses[self.url]['last_modified'], LAST_MODIFIED)
+        self.assertEqual(fetcher.errors, {})
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import base64
+import io
+import logging
+import os
+import random
+import time
+
+from PIL import Image
+
+from odoo.tests.common import BaseCase, tagged
+
+from ..models.image_resizer import IMAGE_SIZES, ImageResizer, resize_image
+
+_logger = logging.getLogger(__name__)
+
+
+def _make_jpeg(width, height, seed=0):
+    ''' A base64 JPEG with some noise, so that it doesn't compress to nothing. '''
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), (rng.randrange(256), rng.randrange(256), rng.randrange(256)))
+    noise = Image.frombytes('L', (width // 8, height // 8), bytes(rng.randrange(256) for _ in range((width // 8) * (height // 8))))
+    image.paste(noise.resize((width, height)).convert('RGB'), (0, 0), Image.new('L', (width, height), 64))
+    data = io.BytesIO()
+    image.save(data, 'JPEG', quality=85)
+    return base64.b64encode(data.getvalue())
+
+
+@tagged('post_install', '-at_install')
+class TestImageResizer(BaseCase):
+
+    def test_resize_configured_sizes(self):
+        resizer = ImageResizer(sizes=(1920, 256))
+        self.addCleanup(resizer.close)
+        [(resized, error)] = resizer.resize([_make_jpeg(2400, 1600)])
+        self.assertIsNone(error)
+        self.assertEqual(set(resized), {1920, 256})
+        self.assertEqual(max(Image.open(io.BytesIO(base64.b64decode(resized[256]))).size), 256)
+
+    def test_truncated_image_fails_alone(self):
+        image = _make_jpeg(800, 600)
+        raw = base64.b64decode(image)
+        truncated = base64.b64encode(raw[:len(raw) // 2])
+        # The header is intact: the image opens, and only fails once decoded
+        Image.open(io.BytesIO(raw[:len(raw) // 2]))
+        resizer = ImageResizer(sizes=IMAGE_SIZES)
+        self.addCleanup(resizer.close)
+        (resized, error), (truncated_resized, truncated_error) = resizer.resize([image, truncated])
+        self.assertIsNone(error)
+        self.assertEqual(set(resized), set(IMAGE_SIZES))
+        self.assertIsNone(truncated_resized)
+        self.assertTrue(truncated_error)
+
+
+@tagged('-standard', 'wds_benchmark')
+class BenchmarkImageResizer(BaseCase):
+    ''' Images per second of the import resizer on a fixed set of generated images, in the current process
+    and in a process pool. Run with --test-tags wds_benchmark. '''
+
+    IMAGES = 48
+
+    def test_resize_throughput(self):
+        fixtures = [_make_jpeg(2000, 1500, seed) for seed in range(self.IMAGES)]
+        expected = [resize_image(image) for image in fixtures[:4]]
+        for workers in (0, min(os.cpu_count() or 1, 4)):
+            resizer = ImageResizer(workers=workers)
+            try:
+                start = time.perf_counter()
+                results = resizer.resize(fixtures)
+                elapsed = time.perf_counter() - start
+            finally:
+                resizer.close()
+            self.assertEqual([resized for resized, error in results[:4]], expected)
+            _logger.info(f'Resize benchmark: {len(fixtures)} images with {workers} workers in {elapsed:.2f}s, {len(fixtures) / elapsed:.1f} images/s.')
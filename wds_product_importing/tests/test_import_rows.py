@@ -0,0 +1,277 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import csv
+import hashlib
+import io
+import itertools
+import logging
+import time
+import tracemalloc
+import zipfile
+from xml.sax.saxutils import escape
+
+from odoo.tests.common import BaseCase, tagged
+
+from ..models.attachment import CsvReader, XlsxReader
+from ..models.product_template import (
+    MAX_BATCH_SIZE, MIN_BATCH_SIZE, clean_data_batch, compile_column_plan, next_batch_size, row_hasher,
+)
+
+_logger = logging.getLogger(__name__)
+
+
+def clean_data_row(row_dict, field_mapping):
+    ''' The dict based row cleaning used before rows were carried as tuples. '''
+    cleaned_dict = {}
+    for field, vals in field_mapping.items():
+        value = row_dict[vals['name']]
+        if value:
+            if vals['type'] in ['float', 'monetary']:
+                value = float(value)
+            elif vals['type'] in ['int']:
+                value = int(value)
+            elif vals['type'] in ['text', 'char', 'html']:
+                try:
+                    value = str(int(value))
+                except Exception:
+                    value = str(value)
+        elif vals['type'] in ['float', 'monetary', 'int']:
+            value = 0
+        cleaned_dict[field] = value
+    return cleaned_dict
+
+
+def row_hash(cleaned_dict):
+    ''' The fingerprint stored by imports before rows were carried as tuples. '''
+    content = repr(sorted((field, value) for field, value in cleaned_dict.items() if field != 'import_hash'))
+    return hashlib.md5(content.encode('utf-8')).hexdigest()
+
+
+def make_xlsx(rows):
+    ''' A minimal xlsx file with one sheet of inline string and number cells. '''
+    def cell(column, index, value):
+        ref = f'{chr(65 + column)}{index + 1}'
+        if isinstance(value, (int, float)):
+            return f'<c r="{ref}"><v>{value}</v></c>'
+        return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{escape(value)}</t></is></c>'
+    sheet_rows = ''.join(
+        f'<row r="{index + 1}">{"".join(cell(column, index, value) for column, value in enumerate(row) if value != "")}</row>'
+        for index, row in enumerate(rows)
+    )
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w') as archive:
+        archive.writestr('[Content_Types].xml', (
+            '<?xml version="1.0" encoding="UTF-8"?><Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+            '</Types>'
+        ))
+        archive.writestr('xl/workbook.xml', (
+            '<?xml version="1.0" encoding="UTF-8"?><workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+            '<sheets><sheet name="Sheet1" sheetId="1" r:id="rId1"/></sheets></workbook>'
+        ))
+        archive.writestr('xl/_rels/workbook.xml.rels', (
+            '<?xml version="1.0" encoding="UTF-8"?><Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+            '</Relationships>'
+        ))
+        archive.writestr('xl/worksheets/sheet1.xml', (
+            '<?xml version="1.0" encoding="UTF-8"?><worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            f'<dimension ref="A1:{chr(64 + len(rows[0]))}{len(rows)}"/><sheetData>{sheet_rows}</sheetData></worksheet>'
+        ))
+    data.seek(0)
+    return data
+
+
+MAPPING = {
+    'product_code': {'name': 'CATALOG #', 'type': 'char'},
+    'name': {'name': 'DESCRIPTION', 'type': 'char'},
+    'description': {'name': 'LONG DESCRIPTION', 'type': 'text'},
+    'list_1': {'name': 'LIST1', 'type': 'float'},
+    'cost_1': {'name': 'COST1', 'type': 'monetary'},
+    'unitqty_1': {'name': 'UNITQTY_1', 'type': 'int'},
+}
+HEADERS = ['UNUSED', 'CATALOG #', 'DESCRIPTION', 'LONG DESCRIPTION', 'LIST1', 'COST1', 'UNITQTY_1']
+ROWS = [
+    ['x', 'A-100', 'Gloves', 'Nitrile gloves', '12.50', '8', '100'],
+    ['x', '007', 'Tape', '', '', '0', ''],
+    ['', ' 5 ', '1_000', 'Line one\nline two', '3', '2.25', '1'],
+    ['x', 12.0, 12.5, 'Évier, "inox"', 4.0, 1.5, 10],
+    ['', '', '', '', '', '', ''],
+    ['x', 'B-200', None, None, '1e3', '-4', '+7'],
+]
+
+
+@tagged('post_install', '-at_install')
+class TestImportRows(BaseCase):
+
+    def test_clean_data_batch_matches_clean_data_row(self):
+        plan = compile_column_plan(MAPPING, HEADERS)
+        cleaned_rows, errors = clean_data_batch(ROWS, plan)
+        self.assertEqual(errors, [])
+        expected = [clean_data_row(dict(zip(HEADERS, row)), MAPPING) for row in ROWS]
+        self.assertEqual(cleaned_rows, [tuple(cleaned[field] for field in plan.fields) for cleaned in expected])
+        # Types must match too: the fingerprint is computed on the repr of the values
+        self.assertEqual(
+            [tuple(map(type, row)) for row in cleaned_rows],
+            [tuple(type(cleaned[field]) for field in plan.fields) for cleaned in expected],
+        )
+
+    def test_row_hasher_matches_row_hash(self):
+        plan = compile_column_plan(MAPPING, HEADERS)
+        cleaned_rows, _errors = clean_data_batch(ROWS, plan)
+        hash_row = row_hasher(plan.fields)
+        for row, cleaned_row in zip(ROWS, cleaned_rows):
+            self.assertEqual(hash_row(cleaned_row), row_hash(clean_data_row(dict(zip(HEADERS, row)), MAPPING)))
+
+    def test_clean_data_batch_skips_invalid_rows(self):
+        plan = compile_column_plan(MAPPING, HEADERS)
+        rows = ROWS[:2] + [['x', 'C-300', 'Bad', '', 'abc', '1', '2']] + ROWS[2:]
+        cleaned_rows, errors = clean_data_batch(rows, plan, first_row=10)
+        self.assertEqual(errors, [(14, 'LIST1', 'abc', "could not convert string to float: 'abc'")])
+        self.assertEqual(cleaned_rows, clean_data_batch(ROWS, plan)[0])
+
+    def test_csv_resume_at_byte_offset(self):
+        content = (
+            '\ufeffCATALOG #,DESCRIPTION,LONG DESCRIPTION\r\n'
+            'A-100,Gloves,"Nitrile\r\ngloves, ""blue"""\r\n'
+            '\r\n'
+            'A-200,Tape\r\n'
+            'A-300,Sink,"Line one\nline two\nline three"\n'
+            'A-400,Évier,Inox,extra\r\n'
+        ).encode('utf-8')
+        with CsvReader(io.BytesIO(content)) as reader:
+            self.assertEqual(reader.headers, ['CATALOG #', 'DESCRIPTION', 'LONG DESCRIPTION'])
+            everything = reader.read(100)
+        self.assertEqual(everything, [
+            ['A-100', 'Gloves', 'Nitrile\r\ngloves, "blue"'],
+            ['A-200', 'Tape', None],
+            ['A-300', 'Sink', 'Line one\nline two\nline three'],
+            ['A-400', 'Évier', 'Inox'],
+        ])
+        for batch_size in (1, 2, 3):
+            rows = []
+            offset = 0
+            while True:
+                with CsvReader(io.BytesIO(content), offset) as reader:
+                    batch = reader.read(batch_size)
+                    offset = reader.tell()
+                if not batch:
+                    break
+                rows += batch
+            self.assertEqual(rows, everything, f'batches of {batch_size}')
+
+    def test_csv_records_resume(self):
+        content = b'CODE,TEXT\r\nA,"multi\r\nline"\r\nB,plain\r\n'
+        with CsvReader(io.BytesIO(content)) as reader:
+            self.assertEqual(reader.next_csv_record(), b'A,"multi\r\nline"\r\n')
+            offset = reader.tell()
+        with CsvReader(io.BytesIO(content), offset) as reader:
+            self.assertEqual(reader.next_csv_record(), b'B,plain\r\n')
+            self.assertIsNone(reader.next_csv_record())
+
+    def test_xlsx_resume_at_row_index(self):
+        sheet = [
+            ['CATALOG #', 'DESCRIPTION', 'LIST1'],
+            ['A-100', 'Line one\nline two', 12.5],
+            ['', '', ''],
+            ['A-200', 'Tape', 3],
+            ['A-300', 'Sink, "inox"', ''],
+        ]
+        with XlsxReader(make_xlsx(sheet)) as reader:
+            self.assertEqual(reader.headers, sheet[0])
+            everything = reader.read(100)
+        self.assertEqual(everything, [
+            ['A-100', 'Line one\nline two', 12.5],
+            ['', '', ''],
+            ['A-200', 'Tape', 3.0],
+            ['A-300', 'Sink, "inox"', ''],
+        ])
+        for batch_size in (1, 2, 3):
+            rows = []
+            offset = 0
+            while True:
+                with XlsxReader(make_xlsx(sheet), offset) as reader:
+                    self.assertEqual(reader.headers, sheet[0])
+                    batch = reader.read(batch_size)
+                    offset = reader.tell()
+                if not batch:
+                    break
+                rows += batch
+            self.assertEqual(rows, everything, f'batches of {batch_size}')
+
+    def test_next_batch_size(self):
+        # 1000 rows in 10s with a 30s target: 3000 wanted, capped to twice the current size
+        self.assertEqual(next_batch_size(1000, 1000, 10, 30), 2000)
+        self.assertEqual(next_batch_size(1000, 1000, 20, 30), 1500)
+        # Never below half the current size, nor out of bounds
+        self.assertEqual(next_batch_size(1000, 1000, 100, 30), 500)
+        self.assertEqual(next_batch_size(150, 150, 100, 30), MIN_BATCH_SIZE)
+        self.assertEqual(next_batch_size(15000, 15000, 1, 30), MAX_BATCH_SIZE)
+        # A short last batch is timed on its own rows
+        self.assertEqual(next_batch_size(1000, 100, 1, 30), 2000)
+        # Nothing to learn from
+        self.assertEqual(next_batch_size(1000, 0, 0, 30), 1000)
+        self.assertEqual(next_batch_size(1000, 1000, 10, 0), 1000)
+
+
+@tagged('-standard', 'wds_benchmark')
+class BenchmarkImportRows(BaseCase):
+    ''' Throughput and peak memory of reading, cleaning and fingerprinting a csv batch, with the tuple rows
+    of the import against the dict rows it replaced. Run with --test-tags wds_benchmark. '''
+
+    ROWS = 20000
+    BATCH_SIZE = 1000
+
+    def _make_csv(self):
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(HEADERS + [f'EXTRA {idx}' for idx in range(20)])
+        for idx in range(self.ROWS):
+            writer.writerow(['x', f'A-{idx}', f'Product {idx}', f'Long description of product {idx}\nsecond line',
+                             f'{idx % 97}.5', str(idx % 13), str(idx % 7)] + [f'value {idx}'] * 20)
+        return output.getvalue().encode('utf-8')
+
+    def _measure(self, run):
+        tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            hashes = run()
+            elapsed = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return hashes, elapsed, peak
+
+    def test_rows_throughput(self):
+        content = self._make_csv()
+        plan = compile_column_plan(MAPPING, HEADERS + [f'EXTRA {idx}' for idx in range(20)])
+
+        def dict_rows():
+            hashes = []
+            reader = csv.DictReader(io.StringIO(content.decode('utf-8')))
+            while True:
+                batch = list(itertools.islice(reader, self.BATCH_SIZE))
+                if not batch:
+                    return hashes
+                hashes += [row_hash(clean_data_row(row, MAPPING)) for row in batch]
+
+        def tuple_rows():
+            hashes = []
+            hash_row = row_hasher(plan.fields)
+            with CsvReader(io.BytesIO(content)) as reader:
+                while True:
+                    batch = reader.read(self.BATCH_SIZE)
+                    if not batch:
+                        return hashes
+                    cleaned_rows, _errors = clean_data_batch(batch, plan)
+                    hashes += map(hash_row, cleaned_rows)
+
+        results = {}
+        for name, run in (('dict rows', dict_rows), ('tuple rows', tuple_rows)):
+            hashes, elapsed, peak = results[name] = self._measure(run)
+            _logger.info(f'Import rows benchmark, {name}: {len(hashes)} rows in {elapsed:.2f}s, '
+                         f'{len(hashes) / elapsed:.0f} rows/s, peak memory {peak / 1024 / 1024:.1f} MiB.')
+        self.assertEqual(results['tuple rows'][0], results['dict rows'][0])
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+# Part of Odoo. See LICENSE file for full copyright and licensing details.
+
+import threading
+import uuid
+
+import odoo
+from odoo import SUPERUSER_ID, api
+from odoo.tests.common import BaseCase, get_db_name, tagged
+
+from ..models.sql_queries import _queries
+
+
+@tagged('post_install', '-at_install')
+class TestParallelImport(BaseCase):
+    ''' Import workers commit on their own cursors, so these tests use real transactions and clean up
+    after themselves. '''
+
+    def setUp(self):
+        super().setUp()
+        self.registry = odoo.registry(get_db_name())
+        suffix = uuid.uuid4().hex[:8]
+        self.size = f'Test Size {suffix}'
+        self.vendor = f'Test Vendor {suffix}'
+        with self.registry.cursor() as cr:
+            env = api.Environment(cr, SUPERUSER_ID, {})
+            self.size_attr_id = env.ref('wds_product_importing.size_attribute').id
+        self.addCleanup(self._cleanup)
+
+    def _cleanup(self):
+        with self.registry.cursor() as cr:
+            cr.execute('DELETE FROM product_attribute_value WHERE name = %s AND attribute_id = %s', (self.size, self.size_attr_id))
+            cr.execute('DELETE FROM res_partner WHERE name = %s', (self.vendor, ))
+
+    def _run_worker(self, barrier, errors, counts):
+        fields = ('product_code', 'size_1', 'unitqty_1', 'vendor_name')
+        rows = [('CODE', self.size, '1', self.vendor)]
+        try:
+            with api.Environment.manage(), self.registry.cursor() as cr:
+                env = api.Environment(cr, SUPERUSER_ID, {'import_parallel': True})
+                barrier.wait(timeout=30)
+                # Take a snapshot first, like a batch resolving its product codes
+                cr.execute('SELECT id FROM product_template LIMIT 1')
+                env['product.template']._create_shared_import_records(rows, fields)
+                # The batch's own inserts must find the shared rows instead of conflicting with them
+                cr.execute(_queries['create_shared_product_attribute_values'], {'sizes': [self.size], 'size_attr_id': self.size_attr_id})
+                cr.execute(_queries['create_shared_res_partner'], {'vendors': [self.vendor]})
+                cr.execute('SELECT COUNT(*) FROM product_attribute_value WHERE name = %s AND attribute_id = %s', (self.size, self.size_attr_id))
+                counts.append(cr.fetchone()[0])
+                cr.commit()
+        except Exception as e:
+            errors.append(e)
+
+    def test_workers_share_new_size(self):
+        barrier = threading.Barrier(2)
+        errors = []
+        counts = []
+        threads = [threading.Thread(target=self._run_worker, args=(barrier, errors, counts)) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(60)
+        self.assertEqual(errors, [])
+        # Each worker saw the size in its own transaction
+        self.assertEqual(counts, [1, 1])
+        with self.registry.cursor() as cr:
+            cr.execute('SELECT COUNT(*) FROM product_attribute_value WHERE name = %s AND attribute_id = %s', (self.size, self.size_attr_id))
+            self.assertEqual(cr.fetchone()[0], 1)
+            cr.execute('SELECT COUNT(*) FROM res_partner WHERE name = %s', (self.vendor, ))
+            self.assertEqual(cr.fetchone()[0], 1)